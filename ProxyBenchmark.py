@@ -0,0 +1,328 @@
+'''
+CS432 Programming Assignment 1
+ProxyBenchmark.py: throughput comparison for ProxyServer.py
+
+Starts a local origin server that answers every request after a fixed delay,
+then runs ProxyServer.py against it once per mode and workload, each time with a
+fresh cache, and drives each run with the same set of concurrent clients:
+  cold  : every request is a miss on a page the proxy has not seen
+  warm  : every request is a hit on one of a few pre-warmed pages
+  mixed : half hits on the pre-warmed pages, half misses
+  tunnel: CONNECT tunnels to a plain TCP stand-in for a TLS server, which sends each one
+          --tunnel-bytes once the client has said hello
+Each run reports requests (tunnels) per second and the median (p50) and 99th percentile (p99)
+latency of a single request, tunnel runs also report MB/s carried and are compared with the
+same transfers made directly. Everything runs on 127.0.0.1, no network access is needed.
+The exit status is 1 if any request failed.
+
+Usage:
+"python ProxyBenchmark.py [--modes serial threads] [--workloads cold warm mixed tunnel] [--clients N] [--requests N]
+                          [--latency MS] [--size BYTES] [--tunnels N] [--tunnel-bytes BYTES] [-- PROXY_ARGS]"
+'''
+
+import argparse
+import os
+import socketserver
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from socket import *
+
+PROXY = os.path.join(os.path.dirname(os.path.abspath(__file__)), "ProxyServer.py")
+HOST = '127.0.0.1'
+
+
+# origin server handler: sleep, then answer with a fixed size body
+class OriginHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1" # keep connections open so the proxy can reuse them
+    disable_nagle_algorithm = True # headers and body are separate writes
+    latency = 0.05
+    body = b"x" * 1024
+
+    def do_GET(self):
+        time.sleep(self.latency)
+        self.send_response(200)
+        self.send_header("Content-Type", "text/html")
+        self.send_header("Cache-Control", "max-age=3600")
+        self.send_header("Content-Length", str(len(self.body)))
+        self.end_headers()
+        self.wfile.write(self.body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+# start the origin server on a free port in a background thread
+def start_origin(latency, size):
+    OriginHandler.latency = latency
+    OriginHandler.body = b"x" * size
+    origin = ThreadingHTTPServer((HOST, 0), OriginHandler)
+    origin.daemon_threads = True
+    threading.Thread(target=origin.serve_forever, daemon=True).start()
+    return origin
+
+
+# stand-in for a TLS server behind a tunnel: waits for the client's hello line, then sends size bytes and closes
+class StandInHandler(socketserver.BaseRequestHandler):
+    block = memoryview(b"x" * 1024 * 1024)
+    size = 8 * 1024 * 1024
+
+    def handle(self):
+        if not self.request.recv(4096):
+            return
+        left = self.size
+        while left:
+            n = self.request.send(self.block[:min(left, len(self.block))])
+            left -= n
+        self.request.shutdown(SHUT_WR)
+
+
+class StandInServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    request_queue_size = 128 # every client connects at once
+
+
+# start the tunnel stand-in on a free port in a background thread
+def start_stand_in(size):
+    StandInHandler.size = size
+    standIn = StandInServer((HOST, 0), StandInHandler)
+    threading.Thread(target=standIn.serve_forever, daemon=True).start()
+    return standIn
+
+
+# grab a free port for the proxy to listen on
+def free_port():
+    s = socket(AF_INET, SOCK_STREAM)
+    s.bind((HOST, 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+
+# start ProxyServer.py in its own cache directory and wait until it accepts connections
+def start_proxy(port, cacheDir, extraArgs):
+    proc = subprocess.Popen([sys.executable, PROXY, HOST, "--port", str(port)] + extraArgs,
+                            cwd=cacheDir, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.time() + 10
+    while time.time() < deadline:
+        try:
+            create_connection((HOST, port), timeout=1).close()
+            return proc
+        except OSError:
+            time.sleep(0.05)
+    proc.kill()
+    raise RuntimeError("proxy did not start")
+
+
+# send one request through the proxy and read the response until the proxy closes
+# returns the length of the body, raises OSError unless the proxy answered 200
+def fetch(proxyPort, path):
+    s = create_connection((HOST, proxyPort), timeout=30)
+    try:
+        s.sendall(f"GET /{path} HTTP/1.1\r\nHost: {HOST}:{proxyPort}\r\nConnection: close\r\n\r\n".encode())
+        response = b""
+        while True:
+            data = s.recv(65536)
+            if not data:
+                break
+            response += data
+    finally:
+        s.close()
+    head, separator, body = response.partition(b"\r\n\r\n")
+    if not separator:
+        raise OSError(f"proxy closed the connection after {len(response)} bytes, before the header block ended")
+    status = head.split(b"\r\n", 1)[0]
+    if status.split(b" ")[1:2] != [b"200"]:
+        raise OSError(f"request failed: {status!r}")
+    return len(body)
+
+
+# open a tunnel to the stand-in at target through the proxy, or connect to it directly when proxyPort
+# is None, say hello and read everything it sends; returns the bytes received
+def fetch_tunnel(proxyPort, target):
+    host, port = target.rsplit(":", 1)
+    s = create_connection((HOST, proxyPort or int(port)), timeout=30)
+    try:
+        received = 0
+        if proxyPort is not None:
+            s.sendall(f"CONNECT {target} HTTP/1.1\r\nHost: {target}\r\n\r\n".encode())
+            head = b""
+            while b"\r\n\r\n" not in head:
+                data = s.recv(4096)
+                if not data:
+                    raise OSError("proxy closed the connection before the tunnel was open")
+                head += data
+            status, _, rest = head.partition(b"\r\n\r\n")
+            if not status.startswith(b"HTTP/1.1 200"):
+                raise OSError(f"tunnel refused: {status.splitlines()[0]!r}")
+            received = len(rest)
+        s.sendall(b"hello\n")
+        buffer = bytearray(1024 * 1024)
+        while True:
+            n = s.recv_into(buffer)
+            if not n:
+                return received
+            received += n
+    finally:
+        s.close()
+
+
+# run every path in paths through the proxy using a number of client threads
+# fetcher(proxyPort, path) sends one request, it raises OSError when the request failed
+# returns (seconds it took, number of failed requests, latency of each successful request in seconds)
+def run_load(proxyPort, paths, clients, fetcher=fetch):
+    pending = list(paths)
+    lock = threading.Lock()
+    errors = []
+    latencies = []
+
+    def client():
+        while True:
+            with lock:
+                if not pending:
+                    return
+                path = pending.pop()
+            start = time.perf_counter()
+            try:
+                fetcher(proxyPort, path)
+                latencies.append(time.perf_counter() - start)
+            except OSError as e:
+                errors.append(e)
+
+    threads = [threading.Thread(target=client) for _ in range(clients)]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return time.perf_counter() - start, len(errors), latencies
+
+
+# the q-th quantile (0 to 1) of the sorted list values, 0 if it is empty
+def percentile(values, q):
+    if not values:
+        return 0
+    return values[min(len(values) - 1, round(q * (len(values) - 1)))]
+
+
+# the paths a workload requests, hits go to the pre-warmed hot pages
+def workload_paths(workload, origin, hot, mode, requests):
+    paths = []
+    for i in range(requests):
+        hit = workload == "warm" or (workload == "mixed" and i % 2)
+        paths.append(hot[i % len(hot)] if hit else f"{origin}/{mode}-{workload}{i}")
+    return paths
+
+
+# fetch and count responses whose body isn't size bytes as errors
+def checked_fetch(size):
+    def fetcher(proxyPort, path):
+        received = fetch(proxyPort, path)
+        if received != size:
+            raise OSError(f"response body of {received} bytes, expected {size}")
+    return fetcher
+
+
+# benchmark one proxy mode on one workload, returns (requests per second, errors, p50 ms, p99 ms)
+def bench_mode(mode, workload, originPort, args):
+    origin = f"{HOST}:{originPort}"
+    fetcher = checked_fetch(args.size)
+    with tempfile.TemporaryDirectory() as cacheDir:
+        port = free_port()
+        proc = start_proxy(port, cacheDir, ["--mode", mode] + args.proxy_args)
+        try:
+            hot = [f"{origin}/hot{i}" for i in range(4)]
+            for path in hot: # warm the cache
+                fetcher(port, path)
+            paths = workload_paths(workload, origin, hot, mode, args.requests)
+            elapsed, errors, latencies = run_load(port, paths, args.clients, fetcher)
+        finally:
+            proc.terminate()
+            proc.wait()
+    latencies.sort()
+    return args.requests / elapsed, errors, percentile(latencies, 0.5) * 1000, percentile(latencies, 0.99) * 1000
+
+
+# tunnel one fetch_tunnel after another and count short transfers as errors
+def checked_tunnel(size):
+    def fetcher(proxyPort, target):
+        received = fetch_tunnel(proxyPort, target)
+        if received != size:
+            raise OSError(f"tunnel carried {received} of {size} bytes")
+    return fetcher
+
+
+# benchmark args.tunnels tunnels through one proxy mode, or directly when mode is None
+# returns (tunnels per second, errors, p50 ms, p99 ms, MB/s)
+def bench_tunnel(mode, standInPort, args):
+    targets = [f"{HOST}:{standInPort}"] * args.tunnels
+    fetcher = checked_tunnel(args.tunnel_bytes)
+    if mode is None:
+        elapsed, errors, latencies = run_load(None, targets, args.clients, fetcher)
+    else:
+        with tempfile.TemporaryDirectory() as cacheDir:
+            port = free_port()
+            proc = start_proxy(port, cacheDir, ["--mode", mode, "--tunnel-ports", str(standInPort)] + args.proxy_args)
+            try:
+                elapsed, errors, latencies = run_load(port, targets, args.clients, fetcher)
+            finally:
+                proc.terminate()
+                proc.wait()
+    latencies.sort()
+    carried = len(latencies) * args.tunnel_bytes / (1024 * 1024)
+    return (args.tunnels / elapsed, errors, percentile(latencies, 0.5) * 1000, percentile(latencies, 0.99) * 1000,
+            carried / elapsed)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Throughput comparison for ProxyServer.py")
+    parser.add_argument("--modes", nargs="+", default=["serial", "threads"])
+    parser.add_argument("--workloads", nargs="+", choices=["cold", "warm", "mixed", "tunnel"],
+                        default=["cold", "warm", "mixed", "tunnel"])
+    parser.add_argument("--clients", type=int, default=16, help="concurrent client connections")
+    parser.add_argument("--requests", type=int, default=200, help="requests per mode")
+    parser.add_argument("--latency", type=float, default=50, help="origin latency in ms")
+    parser.add_argument("--size", type=int, default=4096, help="origin body size in bytes")
+    parser.add_argument("--tunnels", type=int, default=64, help="tunnels opened per mode")
+    parser.add_argument("--tunnel-bytes", type=int, default=8 * 1024 * 1024,
+                        help="bytes the stand-in sends through each tunnel")
+    parser.add_argument("proxy_args", nargs=argparse.REMAINDER,
+                        help="extra arguments passed to ProxyServer.py after --")
+    args = parser.parse_args()
+    args.proxy_args = [a for a in args.proxy_args if a != "--"]
+
+    origin = start_origin(args.latency / 1000, args.size)
+    originPort = origin.server_address[1]
+    print(f"[BENCH] origin latency {args.latency}ms, body {args.size} bytes, "
+          f"{args.clients} clients, {args.requests} requests per run")
+    failed = 0
+    standIn = None
+    if "tunnel" in args.workloads:
+        standIn = start_stand_in(args.tunnel_bytes)
+        tps, errors, p50, p99, mbps = bench_tunnel(None, standIn.server_address[1], args)
+        failed += errors
+        print(f"[BENCH] {args.tunnels} tunnels of {args.tunnel_bytes} bytes, "
+              f"direct: {mbps:8.1f} MB/s  p50 {p50:7.2f} ms  p99 {p99:7.2f} ms  errors: {errors}")
+    for mode in args.modes:
+        for workload in args.workloads:
+            if workload == "tunnel":
+                tps, errors, p50, p99, mbps = bench_tunnel(mode, standIn.server_address[1], args)
+                failed += errors
+                print(f"[BENCH] {mode:>8} {workload:>5}: {tps:8.1f} tun/s  p50 {p50:7.2f} ms  p99 {p99:7.2f} ms  "
+                      f"errors: {errors}  {mbps:8.1f} MB/s")
+                continue
+            rps, errors, p50, p99 = bench_mode(mode, workload, originPort, args)
+            failed += errors
+            print(f"[BENCH] {mode:>8} {workload:>5}: {rps:8.1f} req/s  p50 {p50:7.2f} ms  p99 {p99:7.2f} ms  "
+                  f"errors: {errors}")
+    origin.shutdown()
+    if standIn is not None:
+        standIn.shutdown()
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
\ No newline at end of file
@@ -7,15 +7,114 @@ TEST WITH FIREFOX!
 Added bypass for favicon.ico for "proper" Chrome handling.
 
 Usage:
-"python ProxyServer.py server_ip"
+"python ProxyServer.py server_ip [--port PORT] [--mode serial|threads|asyncio] [--processes N] [--workers N] [--backlog N]
+                             [--memory-cache-bytes N] [--cache-dir DIR] [--cache-max-bytes N] [--cache-policy lru|lfu]
+                             [--compress] [--write-behind-bytes N] [--large-object-bytes N] [--max-object-bytes N]
+                             [--upstream-max-idle N] [--upstream-max-per-host N] [--upstream-idle-timeout SECONDS]
+                             [--connect-timeout SECONDS] [--upstream-timeout SECONDS] [--negative-ttl SECONDS]
+                             [--dns-ttl SECONDS] [--dns-negative-ttl SECONDS]
+                             [--client-idle-timeout SECONDS] [--client-max-requests N] [--default-ttl SECONDS]
+                             [--stale-while-revalidate SECONDS] [--refresh-workers N]
+                             [--prefetch] [--prefetch-workers N] [--prefetch-queue N]
+                             [--tunnel-ports PORT ...] [--tunnel-buffer-bytes N] [--tunnel-idle-timeout SECONDS]
+                             [--metrics-path PATH] [--verbose]"
 [server_ip] : IP Address of Proxy Server
+[--port]    : port to listen on (default 5000)
+[--mode]    : "serial" handles one client at a time, "threads" hands clients to a worker pool,
+              "asyncio" serves every client from one event loop thread
+[--processes] : worker processes accepting on the same port, each serving clients in --mode (default 1)
+[--workers] : number of worker threads in "threads" mode (default 8)
+[--backlog] : accept backlog, also the number of accepted clients allowed to wait for a worker (default 16)
+[--memory-cache-bytes] : memory budget for the in-process response cache, 0 disables it (default 64MB)
+[--cache-dir]          : directory holding cached responses and their index (default ./cache)
+[--cache-max-bytes]    : total size the disk cache may grow to before entries are evicted (default 1GB)
+[--cache-policy]       : evict the least recently used ("lru") or least frequently used ("lfu") entries first
+[--compress]           : store text bodies gzip'd, clients sending Accept-Encoding: gzip get the stored bytes
+                         as they are and the rest get them decompressed
+[--write-behind-bytes] : body bytes waiting to be written to the disk cache before responses stop being
+                         cached until the disk catches up, 0 writes on the serving thread (default 32MB)
+[--large-object-bytes]  : responses larger than this are only cached when requested a second time and are
+                          never held in memory for concurrent requests to share (default 16MB)
+[--max-object-bytes]    : responses larger than this are never cached, only streamed through (default 256MB)
+[--upstream-max-idle]     : idle origin connections kept open for reuse in total, 0 disables pooling (default 32)
+[--upstream-max-per-host] : idle origin connections kept open for one host (default 4)
+[--upstream-idle-timeout] : seconds an idle origin connection is kept before it is closed (default 30)
+[--connect-timeout]       : seconds to wait for a connection to an origin (default 5)
+[--upstream-timeout]      : seconds to wait for each read from an origin (default 30)
+[--negative-ttl]          : seconds an unreachable origin (answered with 502/504) or an error response from
+                            the origin is remembered and answered without contacting it again (default 5)
+[--dns-ttl]               : seconds a resolved origin address is reused, 0 resolves for every new connection (default 60)
+[--dns-negative-ttl]      : seconds a failed origin lookup is remembered (default 10)
+[--client-idle-timeout]   : seconds a client connection may sit idle between requests (default 15)
+[--client-max-requests]   : requests served on one client connection before it is closed (default 100)
+[--default-ttl]           : seconds a response without Cache-Control, Expires or Last-Modified stays fresh (default 0)
+[--stale-while-revalidate] : seconds past expiry a cached response is still served at once while it is
+                             refreshed in the background, 0 always waits for the origin (default 60)
+[--refresh-workers]        : background refreshes running at once (default 4)
+[--prefetch]               : scan HTML pages fetched on a miss for stylesheets, scripts and images linked
+                             relative to the page and fetch those into the cache in the background
+[--prefetch-workers]       : background prefetches running at once (default 4)
+[--prefetch-queue]         : subresources waiting to be prefetched, more are dropped (default 256)
+[--tunnel-ports]           : ports CONNECT may open tunnels to, others get 403 (default 443)
+[--tunnel-buffer-bytes]    : bytes held for each direction of a tunnel (default 1MB)
+[--tunnel-idle-timeout]    : seconds a tunnel may carry nothing before it is closed (default 60)
+[--metrics-path]           : path on the proxy port answering with its metrics, "" turns it off (default /_proxy/metrics)
+[--verbose]                : print every request message and the URL parsed from it
+
+Cached responses follow HTTP freshness rules (Cache-Control, Expires, Last-Modified). A stale entry
+is revalidated with If-None-Match / If-Modified-Since and a 304 from the origin refreshes it in place.
+Within the stale-while-revalidate window the stale copy is served right away and revalidated in the
+background instead.
+Cache files are written by a background thread, so a slow disk delays caching rather than clients,
+and a response becomes a hit only once its file is complete.
+The cache keeps each response's decoded body in its own file and everything else (status, headers,
+validators, expiry) in the index, so a hit sends the origin's own headers with an Age line.
+A Bloom filter of the stored keys, loaded from the index at startup, answers most misses without
+querying the index at all. With --processes a miss in the filter first reads the index's store
+counter, so a key another worker stored a moment ago is found.
+Concurrent misses for the same page share one origin fetch, later requests stream the response
+as the first one receives it.
+With --prefetch the subresources a page links to relative to itself are usually cached by the time
+the browser asks for them.
+Range requests (resumed downloads, media seeking) for a cached page are answered from its file,
+one range as a 206 and several as multipart/byteranges, honouring If-Range. A range of a page
+that isn't cached is passed on to the origin and its 206 relayed without being cached.
+
+With --processes N the proxy forks N workers that accept from the one listening socket and share
+the disk cache, and a worker that exits is replaced. A miss is fetched by one worker at a time:
+workers take a lock file per key (in the cache directory, removed once the fetch is done) and a
+worker that finds it taken waits and serves the copy the other worker cached. The memory cache,
+connection pools and counters belong to each worker. Needs os.fork, so not on Windows.
+
+Metrics are served at server_ip:5000/_proxy/metrics in the Prometheus text format: latency
+histograms for each phase of a request (parse, cache lookup, DNS, connect, origin first byte,
+transfer, cache write and the whole request), cache hits and misses per tier, DNS cache hits,
+misses and resolver time, bytes served per tier and open client connections. With --processes each worker answers with its own numbers.
+
+CONNECT host:port opens a tunnel to the origin, which is how browsers reach HTTPS sites through
+the proxy; nothing in a tunnel is cached. In "serial" and "threads" mode one relay thread per
+process carries every tunnel, moving the bytes with splice() on Linux so they stay in the kernel,
+and the client's worker is free again as soon as the tunnel is open. In "asyncio" mode the event
+loop relays tunnels itself.
+
+GET and HEAD are forwarded, a HEAD of a cached page is answered from the cache and is never cached
+itself. Other methods than these and CONNECT are answered with 501 and the connection is closed.
+
+Client connections are persistent: several requests, pipelined or not, are answered in order on
+one connection. In "threads" mode a connection waiting for its next request doesn't hold a worker,
+one thread watches all of them and hands a connection back to the workers when a request arrives.
 
 Then open up a browser and visit the desired website as follows:
 server_ip:5000/www.website.com/subdomain
 
+An origin on a non-standard port can be reached with server_ip:5000/host:port/subdomain
+
 CURRENT PROBLEMS
 Websites with external .css and .js files do not transmit properly, the client only receives HTML files.
-Slow
+
+ProxyBenchmark.py measures requests per second and p50/p99 latency of cold misses, warm hits and a
+mix of both against a local origin, and the throughput of CONNECT tunnels, run it before and after
+a change to catch slowdowns.
 
 Author: Calvin Stewart
 Email: cstewar2@uoregon.edu
@@ -24,124 +123,3711 @@ Email: cstewar2@uoregon.edu
 from socket import *
 import sys
 import os
+import argparse
+import asyncio
+import bisect
+import concurrent.futures
+import email.utils
+import errno
+import hashlib
+import queue
+import select
+import selectors
+import signal
+import sqlite3
+import tempfile
+import threading
+import time
+import zlib
+from collections import OrderedDict, deque, namedtuple
+from html.parser import HTMLParser
+from urllib.parse import urljoin, urlsplit
 
-def main():
-    # check for the IP in argv
-    if len(sys.argv) <= 1:
-        print('''
-              Usage : "python ProxyServer.py server_ip"
-              [server_ip] : IP Address of Proxy Server
-              ''')
-        sys.exit(2)
+# complete responses the proxy answers with itself
+NOT_FOUND = b"HTTP/1.1 404 Not Found\r\nContent-Length: 0\r\n\r\n"
+BAD_REQUEST = b"HTTP/1.1 400 Bad Request\r\nContent-Length: 0\r\nConnection: close\r\n\r\n"
+FORBIDDEN = b"HTTP/1.1 403 Forbidden\r\nContent-Length: 0\r\nConnection: close\r\n\r\n"
+NOT_IMPLEMENTED = b"HTTP/1.1 501 Not Implemented\r\nContent-Length: 0\r\nConnection: close\r\n\r\n"
+# answer to a CONNECT once the origin connection is open, the tunnel starts right after it
+TUNNEL_ESTABLISHED = b"HTTP/1.1 200 Connection Established\r\n\r\n"
+# answers when the origin can't be reached (502) or doesn't answer in time (504)
+GATEWAY_ERRORS = {
+    502: b"HTTP/1.1 502 Bad Gateway\r\nContent-Length: 0\r\n\r\n",
+    504: b"HTTP/1.1 504 Gateway Timeout\r\nContent-Length: 0\r\n\r\n",
+}
+# status codes that may be cached, the rest are only relayed
+CACHEABLE_STATUS = {200, 203, 300, 301, 308, 410}
+# media types besides text/* worth storing gzip'd with --compress
+COMPRESSIBLE_TYPES = {"application/javascript", "application/json", "application/xml", "application/xhtml+xml",
+                      "application/rss+xml", "image/svg+xml"}
+# headers a 304 must not overwrite in the stored response
+HOP_BY_HOP = {"connection", "keep-alive", "transfer-encoding", "content-length", "te", "trailer", "upgrade"}
+# a Range header asking for more pieces than this is ignored and the whole body is sent
+MAX_RANGES = 16
 
-    # define the server IP and port from argv
-    SERVER = sys.argv[1] # localhost resolves to 127.0.0.1
-    PORT = 5000 # arbitrary
 
-    # create a server socket, bing it to a port and start listening
-    tcpSerSock = socket(AF_INET, SOCK_STREAM) # Init socket
-    tcpSerSock.bind((SERVER, PORT)) # Bind socket to port
-    tcpSerSock.listen(1) # Listen for page requests
+# hit and miss counters for each cache tier plus named event counters, shared by every worker
+class CacheStats:
+    def __init__(self, tiers):
+        self.lock = threading.Lock()
+        self.counts = {tier: {"hits": 0, "misses": 0} for tier in tiers}
+        self.events = {}
+
+    def record(self, tier, hit):
+        with self.lock:
+            self.counts[tier]["hits" if hit else "misses"] += 1
+
+    def count(self, event, n=1):
+        with self.lock:
+            self.events[event] = self.events.get(event, 0) + n
+
+    def snapshot(self):
+        with self.lock:
+            return {tier: dict(counts) for tier, counts in self.counts.items()}, dict(self.events)
+
+    def summary(self):
+        tiers, events = self.snapshot()
+        parts = [f"{tier}: {c['hits']} hits {c['misses']} misses" for tier, c in tiers.items()]
+        parts += [f"{event}: {n}" for event, n in sorted(events.items())]
+        return ", ".join(parts)
+
+
+# latency histograms for the phases of a request, bytes sent to clients by where they came from
+# and the number of open client connections, rendered in the Prometheus text format
+class Metrics:
+    PHASES = ("parse", "lookup", "dns", "connect", "first_byte", "transfer", "cache_write", "request")
+    BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.histograms = {phase: [0] * (len(self.BUCKETS) + 1) for phase in self.PHASES} # the last bucket is +Inf
+        self.sums = dict.fromkeys(self.PHASES, 0.0)
+        self.bytesServed = {}
+        self.bypassedBytes = 0
+        self.tunnelBytes = 0
+        self.active = 0
+        self.tunnels = 0
+
+    # record that phase took seconds
+    def observe(self, phase, seconds):
+        bucket = bisect.bisect_left(self.BUCKETS, seconds)
+        with self.lock:
+            self.histograms[phase][bucket] += 1
+            self.sums[phase] += seconds
+
+    # n bytes sent to a client from tier ("memory", "disk", "origin", "coalesced" or "negative")
+    def served(self, tier, n):
+        with self.lock:
+            self.bytesServed[tier] = self.bytesServed.get(tier, 0) + n
+
+    # n body bytes relayed without being cached because the response was too large
+    def bypassed(self, n):
+        with self.lock:
+            self.bypassedBytes += n
+
+    # a client connection was opened (1) or closed (-1)
+    def connection(self, delta):
+        with self.lock:
+            self.active += delta
+
+    # n bytes carried through a CONNECT tunnel, in either direction
+    def tunneled(self, n):
+        with self.lock:
+            self.tunnelBytes += n
+
+    # a CONNECT tunnel was opened (1) or closed (-1)
+    def tunnel(self, delta):
+        with self.lock:
+            self.tunnels += delta
+
+    # everything above plus the hit and miss counters of stats and the counters of dns, one metric per line
+    def render(self, stats, dns):
+        with self.lock:
+            histograms = {phase: list(counts) for phase, counts in self.histograms.items()}
+            sums = dict(self.sums)
+            bytesServed = dict(self.bytesServed)
+            bypassedBytes = self.bypassedBytes
+            tunnelBytes = self.tunnelBytes
+            active = self.active
+            tunnels = self.tunnels
+        tiers, events = stats.snapshot()
+        dnsHits, dnsMisses, dnsRefreshes, dnsFailures, dnsLookups, dnsTime = dns.snapshot()
+        lines = ["# TYPE proxy_phase_seconds histogram"]
+        for phase in self.PHASES:
+            total = 0
+            for le, n in zip(self.BUCKETS + ("+Inf",), histograms[phase]):
+                total += n
+                lines.append(f'proxy_phase_seconds_bucket{{phase="{phase}",le="{le}"}} {total}')
+            lines.append(f'proxy_phase_seconds_sum{{phase="{phase}"}} {sums[phase]:.6f}')
+            lines.append(f'proxy_phase_seconds_count{{phase="{phase}"}} {total}')
+        lines.append("# TYPE proxy_cache_lookups_total counter")
+        for tier, c in tiers.items():
+            lines.append(f'proxy_cache_lookups_total{{tier="{tier}",result="hit"}} {c["hits"]}')
+            lines.append(f'proxy_cache_lookups_total{{tier="{tier}",result="miss"}} {c["misses"]}')
+        lines.append("# TYPE proxy_cache_hit_ratio gauge")
+        for tier, c in tiers.items():
+            lookups = c["hits"] + c["misses"]
+            lines.append(f'proxy_cache_hit_ratio{{tier="{tier}"}} {c["hits"] / lookups if lookups else 0:.4f}')
+        lines.append("# TYPE proxy_dns_cache_lookups_total counter")
+        lines.append(f'proxy_dns_cache_lookups_total{{result="hit"}} {dnsHits}')
+        lines.append(f'proxy_dns_cache_lookups_total{{result="miss"}} {dnsMisses}')
+        lines.append("# TYPE proxy_dns_refreshes_total counter")
+        lines.append(f"proxy_dns_refreshes_total {dnsRefreshes}")
+        lines.append("# TYPE proxy_dns_failures_total counter")
+        lines.append(f"proxy_dns_failures_total {dnsFailures}")
+        lines.append("# TYPE proxy_dns_resolve_seconds summary")
+        lines.append(f"proxy_dns_resolve_seconds_sum {dnsTime:.6f}")
+        lines.append(f"proxy_dns_resolve_seconds_count {dnsLookups}")
+        lines.append("# TYPE proxy_bytes_served_total counter")
+        for tier, n in sorted(bytesServed.items()):
+            lines.append(f'proxy_bytes_served_total{{tier="{tier}"}} {n}')
+        lines.append("# TYPE proxy_cache_bypassed_bytes_total counter")
+        lines.append(f"proxy_cache_bypassed_bytes_total {bypassedBytes}")
+        lines.append("# TYPE proxy_tunnel_bytes_total counter")
+        lines.append(f"proxy_tunnel_bytes_total {tunnelBytes}")
+        lines.append("# TYPE proxy_events_total counter")
+        for event, n in sorted(events.items()):
+            lines.append(f'proxy_events_total{{event="{event}"}} {n}')
+        lines.append("# TYPE proxy_active_connections gauge")
+        lines.append(f"proxy_active_connections {active}")
+        lines.append("# TYPE proxy_active_tunnels gauge")
+        lines.append(f"proxy_active_tunnels {tunnels}")
+        return "\n".join(lines) + "\n"
+
+    # average time of each phase that happened at all
+    def summary(self):
+        with self.lock:
+            parts = [f"{phase} {self.sums[phase] / sum(counts) * 1000:.2f} ms avg over {sum(counts)}"
+                     for phase, counts in self.histograms.items() if sum(counts)]
+        return ", ".join(parts) or "no requests"
+
+
+# in-process LRU cache of ready-to-send responses, bounded by the total size of the stored bytes
+# entries larger than a quarter of the budget are not stored so one response can't flush the cache
+# each entry is (client header block without Age, body, time it stops being fresh, time its age counts from,
+# header block for clients that don't take gzip or None when the body isn't gzip'd)
+class MemoryCache:
+    def __init__(self, maxBytes):
+        self.maxBytes = maxBytes
+        self.maxEntryBytes = maxBytes // 4
+        self.size = 0
+        self.entries = OrderedDict() # least recently used first
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+            return entry
+
+    def put(self, key, head, body, expiresAt, ageBase, identityHead=None):
+        size = len(head) + len(body)
+        if size > self.maxEntryBytes:
+            return False
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= len(old[0]) + len(old[1])
+            self.entries[key] = (head, body, expiresAt, ageBase, identityHead)
+            self.size += size
+            while self.size > self.maxBytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.size -= len(evicted[0]) + len(evicted[1])
+        return True
+
+
+# compact set of strings that can answer "certainly not in it" and otherwise "probably in it"
+# HASHES bit positions per key come from one blake2b digest, BITS_PER_KEY bits per key of capacity
+# keep false positives near 1% until more than capacity keys were added
+class BloomFilter:
+    HASHES = 7
+    BITS_PER_KEY = 10
+    MIN_CAPACITY = 65536
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.size = capacity * self.BITS_PER_KEY
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def positions(self, key):
+        digest = hashlib.blake2b(key.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return [(h1 + i * h2) % self.size for i in range(self.HASHES)]
+
+    def add(self, key):
+        for p in self.positions(key):
+            self.bits[p >> 3] |= 1 << (p & 7)
+        self.count += 1
+
+    def __contains__(self, key):
+        return all(self.bits[p >> 3] & (1 << (p & 7)) for p in self.positions(key))
+
+
+# a disk cache entry as returned by DiskCache.lookup
+# headers is the origin's header block, responseHead the header block sent to clients on a hit
+# a gzip'd body also has identityHead and identitySize for clients that don't take gzip, otherwise they are None
+CacheEntry = namedtuple("CacheEntry",
+                        "path size headers expiresAt responseHead ageBase etag lastModified identityHead identitySize")
+
+
+# size-bounded cache directory with a persistent sqlite index
+# body files hold only the decoded body, the index holds everything else about an entry: size, last access
+# time, hit count, status, origin headers, validators, expiry time and the pre-built client header block
+# so startup never scans the directory, a hit never parses headers, and eviction walks an index on the
+# policy's ordering instead of sorting every entry. It also remembers the large keys requested once,
+# for SizeGate, where every worker process sees them
+class DiskCache:
+    VERSION = 3 # bump when the layout of entries or body files changes, older caches are emptied
+    SCHEMA = [
+        """CREATE TABLE IF NOT EXISTS entries (
+               key TEXT PRIMARY KEY,
+               path TEXT NOT NULL,
+               size INTEGER NOT NULL,
+               last_access REAL NOT NULL,
+               hits INTEGER NOT NULL DEFAULT 0,
+               headers BLOB NOT NULL,
+               expires_at REAL NOT NULL,
+               status INTEGER NOT NULL,
+               etag TEXT,
+               last_modified TEXT,
+               response_head BLOB NOT NULL,
+               age_base REAL NOT NULL,
+               identity_head BLOB,
+               identity_size INTEGER,
+               seq INTEGER NOT NULL DEFAULT 0)""",
+        "CREATE INDEX IF NOT EXISTS entries_lru ON entries (last_access)",
+        "CREATE INDEX IF NOT EXISTS entries_lfu ON entries (hits, last_access)",
+        "CREATE INDEX IF NOT EXISTS entries_seq ON entries (seq)",
+        """CREATE TABLE IF NOT EXISTS totals (id INTEGER PRIMARY KEY CHECK (id = 0), bytes INTEGER NOT NULL,
+                                              seq INTEGER NOT NULL DEFAULT 0)""",
+        "INSERT OR IGNORE INTO totals VALUES (0, 0, 0)",
+        "CREATE TABLE IF NOT EXISTS requested (key TEXT PRIMARY KEY, at REAL NOT NULL)",
+        "CREATE INDEX IF NOT EXISTS requested_at ON requested (at)",
+    ]
+    # version 3 numbered the stores (seq) for the key filter, the bodies stayed the same
+    MIGRATE = {2: ["ALTER TABLE entries ADD COLUMN seq INTEGER NOT NULL DEFAULT 0",
+                   "ALTER TABLE totals ADD COLUMN seq INTEGER NOT NULL DEFAULT 0"]}
+    ORDER = {"lru": "last_access", "lfu": "hits, last_access"}
+
+    # with shared, other worker processes store into the same index, and a key missing from the
+    # filter is only a miss once the filter has caught up with their stores
+    def __init__(self, cacheDir, maxBytes, policy="lru", shared=False):
+        self.cacheDir = cacheDir
+        self.maxBytes = maxBytes
+        self.shared = shared
+        self.order = self.ORDER[policy]
+        os.makedirs(cacheDir, exist_ok=True)
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(os.path.join(cacheDir, "index.db"), isolation_level=None, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        version = self.db.execute("PRAGMA user_version").fetchone()[0]
+        if version in self.MIGRATE:
+            for statement in self.MIGRATE[version]:
+                self.db.execute(statement)
+        elif version != self.VERSION:
+            self.reset()
+        for statement in self.SCHEMA:
+            self.db.execute(statement)
+        self.db.execute(f"PRAGMA user_version = {self.VERSION}")
+        self.filtered = 0 # lookups the filter answered without the index
+        self.accessed = {} # key -> (last access, hits) not written to the index yet
+        with self.lock:
+            self.rebuild_filter_locked()
+
+    # drop an index (and its files) written by an older version, whose bodies still hold raw responses
+    def reset(self):
+        tables = [row[0] for row in self.db.execute("SELECT name FROM sqlite_master WHERE type = 'table'")]
+        if "entries" in tables:
+            print("[STARTUP] Emptying a disk cache written in an older format")
+            for (path,) in self.db.execute("SELECT path FROM entries").fetchall():
+                self.remove_file(path)
+        self.db.execute("DROP TABLE IF EXISTS entries")
+        self.db.execute("DROP TABLE IF EXISTS totals")
+
+    # where bodies for key live: the sha256 of the key in a two level tree of 256 x 256 directories,
+    # so no directory grows past a few dozen files even with millions of entries
+    def path_for(self, key):
+        digest = hashlib.sha256(key.encode()).hexdigest()
+        return os.path.join(self.cacheDir, digest[:2], digest[2:4], digest)
+
+    # a new temporary file next to where key's body goes, returns (open binary file, its path)
+    # every body gets its own name, store() renames it into place so readers only ever open complete bodies
+    # and a reader that looked up the previous body finds either that body or no file, never the new one
+    def create(self, key):
+        path = self.path_for(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmpPath = tempfile.mkstemp(prefix=os.path.basename(path) + ".", suffix=".tmp", dir=os.path.dirname(path))
+        return os.fdopen(fd, "wb"), tmpPath
+
+    # a filter holding every stored key, sized for twice as many
+    def rebuild_filter_locked(self):
+        self.seq = self.db.execute("SELECT seq FROM totals WHERE id = 0").fetchone()[0]
+        keys = self.db.execute("SELECT key FROM entries").fetchall()
+        self.filter = BloomFilter(max(2 * len(keys), BloomFilter.MIN_CAPACITY))
+        for (key,) in keys:
+            self.filter.add(key)
+
+    # add the keys other processes stored since the last time, one query when there are none
+    def sync_filter_locked(self):
+        seq = self.db.execute("SELECT seq FROM totals WHERE id = 0").fetchone()[0]
+        if seq != self.seq:
+            for (key,) in self.db.execute("SELECT key FROM entries WHERE seq > ?", (self.seq,)):
+                self.filter.add(key)
+            self.seq = seq
+
+    # False when key is certainly not stored, without a query most of the time
+    # evicted and discarded keys stay in the filter until it is rebuilt, they cost a query each
+    def might_have(self, key):
+        if key in self.filter:
+            return True
+        with self.lock:
+            if self.shared:
+                self.sync_filter_locked()
+                if key in self.filter:
+                    return True
+            self.filtered += 1
+            return False
+
+    # the CacheEntry for key, or None, also records the access for eviction
+    # a lookup only reads the index, which never waits for another process's write. The access is
+    # written with this process's next store, discard or size-gate write (see write_accesses_locked)
+    def lookup(self, key):
+        if not self.might_have(key):
+            return None
+        with self.lock:
+            row = self.db.execute("""SELECT path, size, headers, expires_at, response_head, age_base, etag, last_modified,
+                                            identity_head, identity_size
+                                     FROM entries WHERE key = ?""", (key,)).fetchone()
+            if row is None:
+                return None
+            hits = self.accessed.get(key, (0, 0))[1]
+            self.accessed[key] = (time.time(), hits + 1)
+        return CacheEntry(*row)
+
+    # write the accesses lookup() recorded, inside a write transaction
+    def write_accesses_locked(self):
+        if self.accessed:
+            self.db.executemany("UPDATE entries SET last_access = ?, hits = hits + ? WHERE key = ?",
+                                [(at, hits, key) for key, (at, hits) in self.accessed.items()])
+            self.accessed = {}
+
+    # whether key is stored and still fresh, without counting it as an access
+    def is_fresh(self, key):
+        if not self.might_have(key):
+            return False
+        with self.lock:
+            row = self.db.execute("SELECT expires_at FROM entries WHERE key = ?", (key,)).fetchone()
+        return row is not None and row[0] > time.time()
+
+    # move a completely written temporary body into place, index it with its metadata (see entry_metadata)
+    # and evict until the cache fits its budget again
+    def store(self, key, tmpPath, headers, expiresAt, metadata):
+        size = os.path.getsize(tmpPath)
+        if size > self.maxBytes:
+            self.remove_file(tmpPath)
+            return
+        path = tmpPath[:-len(".tmp")]
+        os.replace(tmpPath, path)
+        with self.lock:
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                old = self.db.execute("SELECT size, path FROM entries WHERE key = ?", (key,)).fetchone()
+                self.db.execute("UPDATE totals SET bytes = bytes + ?, seq = seq + 1 WHERE id = 0",
+                                (size - (old[0] if old else 0),))
+                seq = self.db.execute("SELECT seq FROM totals WHERE id = 0").fetchone()[0]
+                self.db.execute("INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, 0, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                                (key, path, size, time.time(), headers, expiresAt, metadata["status"],
+                                 metadata["etag"], metadata["last_modified"], metadata["response_head"],
+                                 metadata["age_base"], metadata["identity_head"], metadata["identity_size"], seq))
+                self.write_accesses_locked()
+                evicted = self.evict_locked(key)
+                self.db.execute("COMMIT")
+            except BaseException:
+                self.db.execute("ROLLBACK")
+                raise
+            self.filter.add(key)
+            if self.filter.count > self.filter.capacity: # too full to filter well
+                self.rebuild_filter_locked()
+        if old and old[1] != path: # the body this one replaces
+            self.remove_file(old[1])
+        for path in evicted:
+            print(f"[CACHE] Evicted {path}")
+            self.remove_file(path)
+
+    # replace the stored headers, expiry and metadata after the origin answered a revalidation with 304
+    def freshen(self, key, headers, expiresAt, metadata):
+        with self.lock:
+            self.db.execute("""UPDATE entries SET headers = ?, expires_at = ?, status = ?, etag = ?, last_modified = ?,
+                                   response_head = ?, age_base = ?, identity_head = ?, identity_size = ? WHERE key = ?""",
+                            (headers, expiresAt, metadata["status"], metadata["etag"], metadata["last_modified"],
+                             metadata["response_head"], metadata["age_base"], metadata["identity_head"],
+                             metadata["identity_size"], key))
+
+    # True if key was requested before, which is then forgotten, otherwise remembers this request
+    # and returns False. Only the last remember keys are kept
+    def requested_before(self, key, remember):
+        with self.lock:
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                before = self.db.execute("DELETE FROM requested WHERE key = ?", (key,)).rowcount > 0
+                if not before:
+                    self.db.execute("INSERT INTO requested VALUES (?, ?)", (key, time.time()))
+                    self.db.execute("""DELETE FROM requested WHERE key IN
+                                           (SELECT key FROM requested ORDER BY at DESC LIMIT -1 OFFSET ?)""", (remember,))
+                self.write_accesses_locked()
+                self.db.execute("COMMIT")
+            except BaseException:
+                self.db.execute("ROLLBACK")
+                raise
+        return before
+
+    # forget key and remove its file, used when the file has gone missing or may no longer be cached
+    # with path, only if key is still stored in that file
+    def discard(self, key, path=None):
+        if not self.might_have(key):
+            return
+        with self.lock:
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                row = self.db.execute("SELECT size, path FROM entries WHERE key = ?", (key,)).fetchone()
+                if row and path is not None and row[1] != path:
+                    row = None
+                if row:
+                    self.db.execute("DELETE FROM entries WHERE key = ?", (key,))
+                    self.db.execute("UPDATE totals SET bytes = bytes - ? WHERE id = 0", (row[0],))
+                self.write_accesses_locked()
+                self.db.execute("COMMIT")
+            except BaseException:
+                self.db.execute("ROLLBACK")
+                raise
+        if row:
+            self.remove_file(row[1])
+
+    # drop entries in policy order until the total fits, never the entry that was just stored
+    def evict_locked(self, keep):
+        evicted = []
+        total = self.db.execute("SELECT bytes FROM totals WHERE id = 0").fetchone()[0]
+        while total > self.maxBytes:
+            victims = self.db.execute(f"SELECT key, path, size FROM entries WHERE key != ? ORDER BY {self.order} LIMIT 16",
+                                      (keep,)).fetchall()
+            if not victims:
+                break
+            for key, path, size in victims:
+                self.db.execute("DELETE FROM entries WHERE key = ?", (key,))
+                total -= size
+                evicted.append(path)
+                if total <= self.maxBytes:
+                    break
+        self.db.execute("UPDATE totals SET bytes = ? WHERE id = 0", (total,))
+        return evicted
+
+    def total_bytes(self):
+        with self.lock:
+            return self.db.execute("SELECT bytes FROM totals WHERE id = 0").fetchone()[0]
+
+    def close(self):
+        with self.lock:
+            self.db.execute("BEGIN IMMEDIATE")
+            self.write_accesses_locked()
+            self.db.execute("COMMIT")
+            self.db.close()
+
+    @staticmethod
+    def remove_file(path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+# idle upstream connections kept per origin host so repeated misses skip the TCP handshake
+# at most maxPerHost idle connections are kept for one host and maxIdle overall, and a
+# connection idle for longer than idleTimeout is closed instead of reused.
+# connections are opaque here, the engine supplies how to check and close them
+class UpstreamPool:
+    def __init__(self, maxIdle, maxPerHost, idleTimeout, isUsable, close):
+        self.maxIdle = maxIdle
+        self.maxPerHost = maxPerHost
+        self.idleTimeout = idleTimeout
+        self.isUsable = isUsable
+        self.close = close
+        self.idle = {} # host -> list of (conn, idle since), most recently used last
+        self.count = 0
+        self.lock = threading.Lock()
+        self.reused = 0
+        self.stale = 0
+
+    # an idle connection to host, or None when a new one has to be opened
+    def acquire(self, host):
+        now = time.monotonic()
+        discard = []
+        conn = None
+        with self.lock:
+            conns = self.idle.get(host)
+            while conns:
+                candidate, since = conns.pop()
+                self.count -= 1
+                if now - since > self.idleTimeout:
+                    discard.append(candidate)
+                elif not self.isUsable(candidate):
+                    self.stale += 1
+                    discard.append(candidate)
+                else:
+                    conn = candidate
+                    self.reused += 1
+                    break
+            if not conns:
+                self.idle.pop(host, None)
+        for candidate in discard:
+            self.close(candidate)
+        return conn
+
+    # hand a connection back after a complete response, closes it if the pool is full
+    def release(self, host, conn):
+        now = time.monotonic()
+        discard = []
+        with self.lock:
+            discard.extend(self.expire_locked(now))
+            conns = self.idle.setdefault(host, [])
+            if len(conns) < self.maxPerHost and self.count < self.maxIdle:
+                conns.append((conn, now))
+                self.count += 1
+            else:
+                discard.append(conn)
+                if not conns:
+                    del self.idle[host]
+        for candidate in discard:
+            self.close(candidate)
+
+    # take every connection idle for too long out of the pool, oldest are first in each list
+    def expire_locked(self, now):
+        expired = []
+        for host in list(self.idle):
+            conns = self.idle[host]
+            while conns and now - conns[0][1] > self.idleTimeout:
+                expired.append(conns.pop(0)[0])
+                self.count -= 1
+            if not conns:
+                del self.idle[host]
+        return expired
+
+    # count a pooled connection that turned out to be closed only once a request was sent on it
+    def record_stale(self):
+        with self.lock:
+            self.stale += 1
+
+    def summary(self):
+        return f"{self.count} idle, {self.reused} reused, {self.stale} stale"
+
+
+# resolved addresses of origin hosts, kept for ttl seconds and failed lookups for negativeTtl seconds
+# getaddrinfo runs on a few resolver threads, never on a serving thread or the event loop, and concurrent
+# lookups of one host share a single call. A host used in the last quarter of its ttl is resolved again
+# in the background so busy hosts never wait for the resolver once they are cached
+class DnsCache:
+    MAX_ENTRIES = 4096
+
+    def __init__(self, ttl, negativeTtl, workers=4):
+        self.ttl = ttl
+        self.negativeTtl = negativeTtl
+        self.entries = {} # (host, port) -> (getaddrinfo result or the error it raised, expiry time)
+        self.pending = {} # (host, port) -> Future of the lookup in progress
+        self.lock = threading.Lock()
+        self.resolver = concurrent.futures.ThreadPoolExecutor(workers, thread_name_prefix="resolver")
+        self.hits = 0
+        self.misses = 0
+        self.failures = 0
+        self.refreshes = 0
+        self.lookups = 0
+        self.lookupTime = 0.0
+
+    # addresses to connect to for host:port, as getaddrinfo returns them; raises the lookup's error
+    def resolve(self, host, port):
+        answer, future = self.find((host, port))
+        return self.addresses(answer if future is None else future.result())
+
+    async def resolve_async(self, host, port):
+        answer, future = self.find((host, port))
+        return self.addresses(answer if future is None else await asyncio.wrap_future(future))
+
+    @staticmethod
+    def addresses(answer):
+        if isinstance(answer, Exception):
+            raise answer
+        return answer
+
+    # (cached answer, None) or (None, Future of the answer)
+    def find(self, key):
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[1] > now:
+                self.hits += 1
+                if entry[1] - now < self.ttl / 4 and key not in self.pending and not isinstance(entry[0], Exception):
+                    self.refreshes += 1
+                    self.start_locked(key)
+                return entry[0], None
+            self.misses += 1
+            future = self.pending.get(key)
+            return None, future if future is not None else self.start_locked(key)
+
+    def start_locked(self, key):
+        future = self.pending[key] = self.resolver.submit(self.lookup, key)
+        return future
+
+    # runs on a resolver thread, the error is returned rather than raised so it can be cached
+    def lookup(self, key):
+        try:
+            return self.lookup_uncached(key)
+        finally:
+            with self.lock:
+                del self.pending[key]
+
+    def lookup_uncached(self, key):
+        start = time.perf_counter()
+        try:
+            answer = getaddrinfo(key[0], key[1], type=SOCK_STREAM)
+            ttl = self.ttl
+        except (OSError, UnicodeError) as e: # UnicodeError for names IDNA can't encode, like "a..b"
+            answer = e if isinstance(e, OSError) else OSError(f"bad host name {key[0]!r}: {e}")
+            ttl = self.negativeTtl
+        now = time.time()
+        with self.lock:
+            self.lookups += 1
+            self.lookupTime += time.perf_counter() - start
+            old = self.entries.get(key)
+            if isinstance(answer, Exception):
+                self.failures += 1
+                if old is not None and old[1] > now and not isinstance(old[0], Exception):
+                    ttl = 0 # a failed refresh doesn't replace an answer that is still valid
+            if ttl > 0:
+                if len(self.entries) >= self.MAX_ENTRIES:
+                    self.entries = {k: e for k, e in self.entries.items() if e[1] > now}
+                    if len(self.entries) >= self.MAX_ENTRIES:
+                        self.entries.clear()
+                self.entries[key] = (answer, now + ttl)
+        return answer
+
+    # (hits, misses, background refreshes, failed lookups, lookups, seconds spent in getaddrinfo)
+    def snapshot(self):
+        with self.lock:
+            return self.hits, self.misses, self.refreshes, self.failures, self.lookups, self.lookupTime
+
+    def summary(self):
+        with self.lock:
+            average = self.lookupTime / self.lookups * 1000 if self.lookups else 0
+            return (f"{self.hits} hits {self.misses} misses, {self.refreshes} refreshed ahead, "
+                    f"{self.failures} failed, {self.lookups} lookups averaging {average:.1f} ms "
+                    f"({self.lookupTime:.2f} s in total)")
+
+
+# recent upstream failures, so requests for dead origins and missing pages fail fast instead of tying up
+# a worker on the origin again: error responses (4xx/5xx) per URL and unreachable hosts, each for ttl seconds
+class NegativeCache:
+    MAX_ENTRIES = 4096
+    MAX_RESPONSE_BYTES = 64 * 1024
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.responses = {} # key -> (raw response, whether it is delimited, expiry time)
+        self.hosts = {} # host -> (status to answer with, expiry time)
+        self.lock = threading.Lock()
+
+    # (raw error response, whether it is delimited) recently received for key, or None
+    def response(self, key):
+        with self.lock:
+            entry = self.responses.get(key)
+            if entry is None or entry[2] <= time.time():
+                return None
+            return entry[0], entry[1]
+
+    def put_response(self, key, response, framed):
+        if self.ttl > 0:
+            with self.lock:
+                self.put_locked(self.responses, key, (response, framed, time.time() + self.ttl))
+
+    # the gateway error status for a host that recently failed, or None
+    def host_down(self, host):
+        with self.lock:
+            entry = self.hosts.get(host)
+            if entry is None or entry[1] <= time.time():
+                return None
+            return entry[0]
+
+    def mark_down(self, host, status):
+        if self.ttl > 0:
+            with self.lock:
+                self.put_locked(self.hosts, host, (status, time.time() + self.ttl))
+
+    def put_locked(self, table, key, entry):
+        if len(table) >= self.MAX_ENTRIES:
+            now = time.time()
+            for old in [k for k, e in table.items() if e[-1] <= now]:
+                del table[old]
+            if len(table) >= self.MAX_ENTRIES:
+                table.clear()
+        table[key] = entry
+
+
+# the origin couldn't be reached or didn't answer before the timeout, nothing was relayed yet
+# status is the gateway error to send the client
+class UpstreamError(OSError):
+    def __init__(self, hostname, status, reason):
+        super().__init__(f"{hostname}: {reason}")
+        self.status = status
+
+
+# one upstream fetch in progress, which requests for the same key follow instead of fetching again
+# the leader publishes every block it relays; followers replay the blocks from the start and wait
+# for more. Works for both engines: threads wait on the condition, coroutines on futures
+# a large response that followers are already part way through is kept only WINDOW_BYTES back from
+# the newest block, a follower that falls further behind is cut off
+class Flight:
+    WINDOW_BYTES = 8 * 1024 * 1024
+
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.blocks = []
+        self.base = 0 # number of blocks dropped from the front of blocks
+        self.held = 0 # bytes in blocks
+        self.done = False
+        self.framed = False # set by the leader once the whole response was relayed
+        self.writing = False # still being written to the cache, later requests keep following it until then
+        self.started = False # a follower has taken blocks
+        self.followers = 0 # requests that joined it
+        self.abandoned = False # too large to share, nothing more is published
+        self.bounded = False # too large to share but already started, only the window is kept
+        self.caching = False # abandoned or bounded but going to the cache, new followers wait for it there
+        self.waiters = [] # (event loop, future) of coroutines waiting for the next block
+
+    def publish(self, data):
+        with self.cond:
+            if not self.abandoned:
+                self.blocks.append(data)
+                self.held += len(data)
+                if self.bounded:
+                    dropped = 0
+                    while self.held > self.WINDOW_BYTES and dropped < len(self.blocks) - 1:
+                        self.held -= len(self.blocks[dropped])
+                        dropped += 1
+                    del self.blocks[:dropped]
+                    self.base += dropped
+                self.wake_locked()
+
+    def finish(self):
+        with self.cond:
+            self.done = True
+            self.wake_locked()
+
+    def wake_locked(self):
+        self.cond.notify_all()
+        for loop, future in self.waiters:
+            loop.call_soon_threadsafe(lambda f=future: f.done() or f.set_result(None))
+        self.waiters = []
+
+    # the response is in the cache or won't be
+    def written(self):
+        with self.cond:
+            self.writing = False
+            self.wake_locked()
+
+    # stop sharing a response too large to hold in memory: followers that haven't taken any block yet
+    # find the flight empty, and wait until the leader has written it to the cache if it is caching it,
+    # then look there or fetch it themselves. If some follower is already part way through, only the
+    # last WINDOW_BYTES are kept from now on and False is returned: the leader has to keep publishing.
+    # Can be called again when caching falls through
+    def abandon(self, caching):
+        with self.cond:
+            if self.caching != caching or not (self.abandoned or self.bounded):
+                self.caching = caching
+                if self.started:
+                    self.bounded = True
+                else:
+                    self.blocks = []
+                    self.held = 0
+                    self.abandoned = True
+                self.wake_locked()
+            return self.abandoned
+
+    # blocks published after the first index ones and whether the flight is done, waits until there
+    # are some or it is. (None, True) when the block at index has been dropped already
+    def read(self, index):
+        with self.cond:
+            while self.base + len(self.blocks) <= index and not self.done and not self.abandoned:
+                self.cond.wait()
+            return self.take_locked(index)
+
+    async def read_async(self, index):
+        while True:
+            with self.cond:
+                if self.base + len(self.blocks) > index or self.done or self.abandoned:
+                    return self.take_locked(index)
+                future = asyncio.get_running_loop().create_future()
+                self.waiters.append((asyncio.get_running_loop(), future))
+            await future
+
+    def take_locked(self, index):
+        if index < self.base:
+            return None, True
+        self.started = self.started or self.base + len(self.blocks) > index
+        return self.blocks[index - self.base:], self.done or self.abandoned
+
+    # waits until an abandoned or bounded flight that is caching its response has landed and been written
+    def settle(self):
+        with self.cond:
+            while self.caching and (not self.done or self.writing):
+                self.cond.wait()
+
+    async def settle_async(self):
+        while True:
+            with self.cond:
+                if not self.caching or (self.done and not self.writing):
+                    return
+                future = asyncio.get_running_loop().create_future()
+                self.waiters.append((asyncio.get_running_loop(), future))
+            await future
+
+
+# origin fetches by key across worker processes, a lock is (open file held with flock, its path)
+# each key has its own lock file in the directory, named by the digest of the key, which the holder
+# removes on release. With no directory (one process) every lock is granted at once and HELD_ALONE
+# stands for it
+class ProcessLocks:
+    POLL = 0.01 # seconds between attempts while another process holds a lock
+    HELD_ALONE = -1
+
+    def __init__(self, directory=None):
+        self.directory = directory
+        if directory is not None:
+            import fcntl
+            self.fcntl = fcntl
+            os.makedirs(directory, exist_ok=True)
+
+    def path_for(self, key):
+        return os.path.join(self.directory, hashlib.sha256(key.encode()).hexdigest() + ".lock")
+
+    # the lock for key, or None if another process holds it
+    def try_acquire(self, key):
+        if self.directory is None:
+            return self.HELD_ALONE
+        path = self.path_for(key)
+        while True:
+            fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                self.fcntl.flock(fd, self.fcntl.LOCK_EX | self.fcntl.LOCK_NB)
+            except BlockingIOError:
+                os.close(fd)
+                return None
+            try:
+                held = os.fstat(fd)
+                current = os.stat(path)
+                if (held.st_dev, held.st_ino) == (current.st_dev, current.st_ino):
+                    return fd, path
+            except FileNotFoundError:
+                pass
+            os.close(fd) # the previous holder removed this file on release, lock the one at path now
+
+    # (the lock for key, whether another process held it first), waits at most timeout seconds
+    # for the other process and then gives up with (None, True)
+    def acquire(self, key, timeout):
+        deadline = time.monotonic() + timeout
+        waited = False
+        while True:
+            lock = self.try_acquire(key)
+            if lock is not None or time.monotonic() >= deadline:
+                return lock, waited
+            waited = True
+            time.sleep(self.POLL)
+
+    async def acquire_async(self, key, timeout):
+        deadline = time.monotonic() + timeout
+        waited = False
+        while True:
+            lock = self.try_acquire(key)
+            if lock is not None or time.monotonic() >= deadline:
+                return lock, waited
+            waited = True
+            await asyncio.sleep(self.POLL)
+
+    def release(self, lock):
+        if lock is not None and lock != self.HELD_ALONE:
+            fd, path = lock
+            try:
+                os.unlink(path) # while still held, so nobody else has locked this file
+            except FileNotFoundError:
+                pass
+            os.close(fd) # closing the file drops the flock
+
+
+# the flights in progress by cache key
+class SingleFlight:
+    def __init__(self):
+        self.flights = {}
+        self.lock = threading.Lock()
+
+    # (flight, True) when the caller has to fetch key itself, (flight, False) when it should follow
+    def join(self, key):
+        with self.lock:
+            flight = self.flights.get(key)
+            if flight is not None:
+                flight.followers += 1
+                return flight, False
+            flight = self.flights[key] = Flight()
+            return flight, True
+
+    # the leader is done; the flight stays joinable while its response is still being written to the cache
+    def land(self, key, flight):
+        with self.lock:
+            if self.flights.get(key) is flight and not flight.writing:
+                del self.flights[key]
+        flight.finish()
+
+    # the flight's response is in the cache (or won't be), new requests can look there again
+    def written(self, key, flight):
+        with self.lock:
+            if self.flights.get(key) is flight:
+                del self.flights[key]
+            flight.written()
+
+
+# background refreshes of stale entries, one per key and at most workers at a time
+# a refresh that doesn't fit is dropped, the next stale hit on the key asks again
+class Refresher:
+    def __init__(self, workers):
+        self.workers = workers
+        self.pending = set()
+        self.tasks = set() # running asyncio refreshes, referenced until they finish
+        self.lock = threading.Lock()
+
+    def claim(self, key):
+        with self.lock:
+            if key in self.pending or len(self.pending) >= self.workers:
+                return False
+            self.pending.add(key)
+            return True
+
+    def release(self, key):
+        with self.lock:
+            self.pending.discard(key)
+
+    # run job() on its own thread
+    def submit(self, key, job):
+        if not self.claim(key):
+            return False
+
+        def run():
+            try:
+                job()
+            finally:
+                self.release(key)
+        threading.Thread(target=run, daemon=True).start()
+        return True
+
+    # run the coroutine job() as a task on the running event loop
+    def submit_async(self, key, job):
+        if not self.claim(key):
+            return False
+
+        async def run():
+            try:
+                await job()
+            finally:
+                self.release(key)
+        task = asyncio.get_running_loop().create_task(run())
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return True
+
+
+# cache file writes, done on one writer thread so a slow disk never holds up the bytes sent to clients
+# jobs run in the order they were submitted. At most maxBytes of body data wait at once, a job that
+# doesn't fit is refused; jobs of size 0 always fit. With maxBytes 0 every job runs right away
+# on the caller's thread instead. The thread starts with the first job, so after any fork
+class WriteBehind:
+    def __init__(self, maxBytes):
+        self.maxBytes = maxBytes
+        self.queued = 0
+        self.jobs = deque() # (size, function, arguments)
+        self.cond = threading.Condition()
+        self.thread = None
+
+    # queue job(*args) holding size bytes, returns False if it doesn't fit
+    def submit(self, size, job, *args):
+        if self.maxBytes == 0:
+            job(*args)
+            return True
+        with self.cond:
+            if size and self.queued + size > self.maxBytes:
+                return False
+            self.queued += size
+            self.jobs.append((size, job, args))
+            self.cond.notify()
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name="cache-writer", daemon=True)
+                self.thread.start()
+        return True
+
+    def run(self):
+        while True:
+            with self.cond:
+                while not self.jobs:
+                    self.cond.wait()
+                size, job, args = self.jobs.popleft()
+            try:
+                job(*args)
+            except Exception as e:
+                print(f"[ERROR] Cache write failed:\n{e}")
+            finally:
+                with self.cond:
+                    self.queued -= size
+
+
+# whether a response of some size may be cached: up to largeBytes always, up to maxBytes only when
+# it is requested a second time, never above maxBytes. The first requests of the last MAX_REMEMBERED
+# large keys are remembered in the disk cache's index, so a second request counts in any worker process.
+# Requests following the fetch (again) are second requests too
+class SizeGate:
+    MAX_REMEMBERED = 4096
+
+    def __init__(self, largeBytes, maxBytes):
+        self.largeBytes = largeBytes
+        self.maxBytes = maxBytes
+
+    def admit(self, key, size, again=False):
+        if size > self.maxBytes:
+            return False
+        if size <= self.largeBytes or again:
+            return True
+        return diskCache.requested_before(key, self.MAX_REMEMBERED)
+
+
+# subresources of HTML pages fetched into the cache before the browser asks for them
+# at most maxQueued wait at once, the rest are dropped. In threads and serial mode workers are
+# threads, in asyncio mode they are tasks on the event loop (started with start_async)
+class Prefetcher:
+    def __init__(self, workers, maxQueued):
+        self.workers = workers
+        self.queue = queue.Queue(maxQueued)
+        self.pending = set() # keys queued or being fetched
+        self.tasks = []
+        self.lock = threading.Lock()
+
+    # queue hostname/filename unless it is already queued, called on the event loop in asyncio mode
+    def submit(self, hostname, filename):
+        key = cache_key(hostname, filename)
+        with self.lock:
+            if key in self.pending:
+                return
+            try:
+                self.queue.put_nowait((hostname, filename))
+            except (queue.Full, asyncio.QueueFull):
+                cacheStats.count("prefetches dropped")
+                return
+            self.pending.add(key)
+
+    def done(self, hostname, filename):
+        with self.lock:
+            self.pending.discard(cache_key(hostname, filename))
+
+    def start(self):
+        for _ in range(self.workers):
+            threading.Thread(target=self.work, daemon=True).start()
+
+    def work(self):
+        while True:
+            hostname, filename = self.queue.get()
+            try:
+                prefetch(hostname, filename)
+            finally:
+                self.done(hostname, filename)
+
+    def start_async(self):
+        self.queue = asyncio.Queue(self.queue.maxsize)
+        loop = asyncio.get_running_loop()
+        self.tasks = [loop.create_task(self.work_async()) for _ in range(self.workers)]
+
+    async def work_async(self):
+        while True:
+            hostname, filename = await self.queue.get()
+            try:
+                await prefetch_async(hostname, filename)
+            finally:
+                self.done(hostname, filename)
+
+
+# finds the stylesheets, scripts and images an HTML page loads through the proxy while the page
+# streams past and submits them to the prefetcher. The browser sees the page at proxy/host/filename,
+# so only links it resolves under proxy/host/ come back here; root-relative and absolute links go
+# elsewhere and are skipped. Links past the first MAX_BYTES of the page or beyond MAX_LINKS are left
+# for the browser to ask for
+class LinkScanner(HTMLParser):
+    MAX_LINKS = 64
+    MAX_BYTES = 1024 * 1024
+    LINK_RELS = {"stylesheet", "preload", "modulepreload", "icon"}
+    PROXY = "proxy.invalid" # stands for the proxy's own address when resolving links
+
+    def __init__(self, hostname, filename):
+        super().__init__()
+        self.hostname = hostname
+        self.base = f"http://{self.PROXY}/{hostname}/{filename}" # the page's URL as the browser sees it
+        self.found = set()
+        self.scanned = 0
+
+    # feed decoded body parts, URLs are ASCII so the charset doesn't matter
+    def scan(self, body):
+        for part in body:
+            if self.scanned >= self.MAX_BYTES or len(self.found) >= self.MAX_LINKS:
+                return
+            self.scanned += len(part)
+            self.feed(bytes(part).decode("latin-1"))
+
+    def handle_starttag(self, tag, attrs):
+        attrs = dict(attrs)
+        url = None
+        if tag == "base" and attrs.get("href"):
+            self.base = urljoin(self.base, attrs["href"])
+        elif tag == "link" and self.LINK_RELS & set((attrs.get("rel") or "").lower().split()):
+            url = attrs.get("href")
+        elif tag in ("script", "img", "source"):
+            url = attrs.get("src")
+        if url:
+            self.add(url.strip())
+
+    def add(self, url):
+        parts = urlsplit(urljoin(self.base, url))
+        prefix = f"/{self.hostname}/"
+        if parts.scheme != "http" or parts.netloc != self.PROXY or not parts.path.startswith(prefix):
+            return
+        filename = parts.path[len(prefix):] + ("?" + parts.query if parts.query else "")
+        if filename not in self.found and len(self.found) < self.MAX_LINKS:
+            self.found.add(filename)
+            prefetcher.submit(self.hostname, filename)
+
+
+# one direction of a CONNECT tunnel: bytes read from src wait here until dst takes them
+# with os.splice (Linux) they wait in a kernel pipe and never pass through python, elsewhere in a
+# buffer of capacity bytes filled with recv_into. Both sockets are non-blocking
+class TunnelPipe:
+    SPLICE = hasattr(os, "splice")
+
+    def __init__(self, src, dst, capacity):
+        self.src = src
+        self.dst = dst
+        self.capacity = capacity
+        self.pending = 0 # bytes read from src and not yet sent to dst
+        self.full = False # the pipe took no more although pending < capacity (it counts pages, not bytes)
+        self.eof = False # src has closed its side
+        self.shut = False # the close has been passed on to dst
+        if self.SPLICE:
+            self.r, self.w = os.pipe()
+            self.capacity = self.grow_pipe(capacity)
+        else:
+            self.buffer = memoryview(bytearray(capacity))
+            self.start = 0 # pending bytes are buffer[start:start + pending]
+
+    # ask for a pipe of size bytes, returns the size the kernel granted
+    def grow_pipe(self, size):
+        try:
+            import fcntl
+            return fcntl.fcntl(self.w, fcntl.F_SETPIPE_SZ, size)
+        except (ImportError, AttributeError, OSError): # no fcntl, or above /proc/sys/fs/pipe-max-size
+            return 65536
+
+    # whether to wait for src to become readable
+    def wants_read(self):
+        return not self.eof and not self.full and self.pending < self.capacity
+
+    # read what src has into the pipe and pass on as much as dst takes, returns the bytes read
+    def fill(self):
+        try:
+            if self.SPLICE:
+                n = os.splice(self.src.fileno(), self.w, self.capacity - self.pending,
+                              flags=os.SPLICE_F_MOVE | os.SPLICE_F_NONBLOCK)
+            else:
+                if self.pending == 0:
+                    self.start = 0
+                end = self.start + self.pending
+                if end == self.capacity: # move the pending bytes to the front to make room
+                    self.buffer[:self.pending] = self.buffer[self.start:end]
+                    self.start, end = 0, self.pending
+                n = self.src.recv_into(self.buffer[end:])
+        except BlockingIOError:
+            self.full = self.pending > 0
+            return 0
+        if n == 0:
+            self.eof = True
+        self.pending += n
+        self.drain()
+        return n
+
+    # send pending bytes to dst until it would block
+    def drain(self):
+        while self.pending:
+            try:
+                if self.SPLICE:
+                    n = os.splice(self.r, self.dst.fileno(), self.pending,
+                                  flags=os.SPLICE_F_MOVE | os.SPLICE_F_NONBLOCK)
+                else:
+                    n = self.dst.send(self.buffer[self.start:self.start + self.pending])
+                    self.start += n
+            except BlockingIOError:
+                return
+            self.pending -= n
+            self.full = False
+        if self.eof and not self.shut:
+            self.shut = True
+            self.dst.shutdown(SHUT_WR) # pass the half-close on
+
+    # src has closed and everything it sent has reached dst
+    def finished(self):
+        return self.eof and self.pending == 0
+
+    def close(self):
+        if self.SPLICE:
+            os.close(self.r)
+            os.close(self.w)
+
+
+# the CONNECT tunnels of a worker process, relayed in both directions by one thread waiting on every
+# tunnel socket at once (epoll on Linux), so an open tunnel doesn't hold a worker and copies happen
+# only when a socket is ready. A tunnel is closed once both sides have closed, on an error, or when no
+# byte has moved for idleTimeout seconds. The thread starts with the first tunnel, so after any fork
+class TunnelRelay:
+    SWEEP_INTERVAL = 1 # seconds between checks for idle tunnels
+
+    def __init__(self, bufferBytes, idleTimeout):
+        self.bufferBytes = bufferBytes
+        self.idleTimeout = idleTimeout
+        self.added = [] # (client, upstream) waiting for the relay thread
+        self.lock = threading.Lock()
+        self.thread = None
+        self.wakeup = None # socket pair, a byte on it tells the thread to look at added
+
+    # relay between the two connected sockets from now on, the relay closes them
+    def add(self, client, upstream):
+        with self.lock:
+            self.added.append((client, upstream))
+            if self.thread is None:
+                self.wakeup = socketpair()
+                self.thread = threading.Thread(target=self.run, name="tunnel-relay", daemon=True)
+                self.thread.start()
+        try:
+            self.wakeup[1].send(b"\0")
+        except BlockingIOError: # already woken
+            pass
+
+    def run(self):
+        selector = selectors.DefaultSelector()
+        self.wakeup[0].setblocking(False)
+        self.wakeup[1].setblocking(False)
+        selector.register(self.wakeup[0], selectors.EVENT_READ)
+        tunnels = {} # socket -> (pipe reading it, pipe writing it, last activity as [time])
+        swept = time.monotonic()
+        while True:
+            for key, events in selector.select(self.SWEEP_INTERVAL):
+                if key.fileobj is self.wakeup[0]:
+                    self.open_added(selector, tunnels)
+                elif key.fileobj in tunnels:
+                    self.ready(selector, tunnels, key.fileobj, events)
+            now = time.monotonic()
+            if now - swept >= self.SWEEP_INTERVAL:
+                swept = now
+                for sock, (_, _, active) in list(tunnels.items()):
+                    if sock in tunnels and now - active[0] > self.idleTimeout: # not closed with its other side
+                        print("[CONN] Closing idle tunnel")
+                        self.close(selector, tunnels, sock)
+
+    # register the tunnels add() queued
+    def open_added(self, selector, tunnels):
+        try:
+            while self.wakeup[0].recv(4096):
+                pass
+        except BlockingIOError:
+            pass
+        with self.lock:
+            added, self.added = self.added, []
+        for client, upstream in added:
+            pipes = []
+            try:
+                client.setblocking(False)
+                upstream.setblocking(False)
+                pipes.append(TunnelPipe(client, upstream, self.bufferBytes))
+                pipes.append(TunnelPipe(upstream, client, self.bufferBytes))
+                selector.register(client, selectors.EVENT_READ)
+                selector.register(upstream, selectors.EVENT_READ)
+            except OSError as e: # out of descriptors, most likely: drop this tunnel, keep the others
+                print(f"[ERROR] Could not relay a tunnel, closing it: {e}")
+                for s in (client, upstream):
+                    if s in selector.get_map():
+                        selector.unregister(s)
+                    s.close()
+                for pipe in pipes:
+                    pipe.close()
+                continue
+            up, down = pipes
+            active = [time.monotonic()]
+            tunnels[client] = (up, down, active)
+            tunnels[upstream] = (down, up, active)
+            metrics.tunnel(1)
+
+    # move what sock has for the other side and what the other side has for sock
+    def ready(self, selector, tunnels, sock, events):
+        reading, writing, active = tunnels[sock]
+        try:
+            sent = writing.pending
+            if events & selectors.EVENT_WRITE:
+                writing.drain()
+            sent -= writing.pending
+            received = reading.fill() if events & selectors.EVENT_READ else 0
+            finished = reading.finished() and writing.finished()
+            if not finished:
+                for s in (reading.src, reading.dst):
+                    self.watch(selector, tunnels, s)
+        except OSError as e:
+            if e.errno not in (errno.ECONNRESET, errno.EPIPE, errno.ENOTCONN):
+                print(f"[ERROR] Tunnel failed: {e}")
+            self.close(selector, tunnels, sock)
+            return
+        if sent or received:
+            active[0] = time.monotonic()
+            metrics.tunneled(received)
+        if finished:
+            self.close(selector, tunnels, sock)
+
+    # wait for what sock's two pipes need: room to read into and bytes to send
+    def watch(self, selector, tunnels, sock):
+        reading, writing, _ = tunnels[sock]
+        events = (selectors.EVENT_READ if reading.wants_read() else 0) | \
+                 (selectors.EVENT_WRITE if writing.pending else 0)
+        registered = sock in selector.get_map()
+        if events == 0:
+            if registered:
+                selector.unregister(sock)
+        elif registered:
+            if selector.get_key(sock).events != events:
+                selector.modify(sock, events)
+        else:
+            selector.register(sock, events)
+
+    def close(self, selector, tunnels, sock):
+        reading, writing, _ = tunnels[sock]
+        metrics.tunnel(-1)
+        for s in (reading.src, reading.dst):
+            del tunnels[s]
+            if s in selector.get_map():
+                selector.unregister(s)
+            s.close()
+        reading.close()
+        writing.close()
+
+
+# keep-alive client connections between requests in "threads" mode, watched by one thread waiting on
+# all of them at once so an idle client doesn't hold a worker. A connection that becomes readable goes
+# back on the workers' queue with its parser and request count, one quiet for timeout seconds is closed
+class IdleClients:
+    SWEEP_INTERVAL = 1 # seconds between checks for connections idle too long
+
+    def __init__(self, timeout):
+        self.timeout = timeout
+        self.added = [] # (socket, address, parser, requests served, parked at) waiting for the thread
+        self.lock = threading.Lock()
+        self.clients = None
+        self.wakeup = None # socket pair, a byte on it tells the thread to look at added
+
+    # hand readable connections to the clients queue from now on
+    def start(self, clients):
+        self.clients = clients
+        self.wakeup = socketpair()
+        for sock in self.wakeup:
+            sock.setblocking(False)
+        threading.Thread(target=self.run, name="idle-clients", daemon=True).start()
+
+    # wait for the next request on tcpCliSock without a worker
+    def park(self, tcpCliSock, addr, parser, served):
+        with self.lock:
+            self.added.append((tcpCliSock, addr, parser, served, time.monotonic()))
+        try:
+            self.wakeup[1].send(b"\0")
+        except BlockingIOError: # already woken
+            pass
+
+    def run(self):
+        selector = selectors.DefaultSelector()
+        selector.register(self.wakeup[0], selectors.EVENT_READ)
+        parked = {} # socket -> (address, parser, requests served, parked at)
+        swept = time.monotonic()
+        while True:
+            for key, _ in selector.select(self.SWEEP_INTERVAL):
+                if key.fileobj is self.wakeup[0]:
+                    self.watch_added(selector, parked)
+                else:
+                    selector.unregister(key.fileobj)
+                    addr, parser, served, _ = parked.pop(key.fileobj)
+                    self.clients.put((key.fileobj, addr, parser, served)) # blocks while the queue is full
+            now = time.monotonic()
+            if now - swept >= self.SWEEP_INTERVAL:
+                swept = now
+                for sock, (addr, _, _, since) in list(parked.items()):
+                    if now - since > self.timeout:
+                        print(f"[CONN] Closing idle connection from {addr}")
+                        selector.unregister(sock)
+                        del parked[sock]
+                        self.close(sock)
+
+    # start watching the connections park() queued
+    def watch_added(self, selector, parked):
+        try:
+            while self.wakeup[0].recv(4096):
+                pass
+        except BlockingIOError:
+            pass
+        with self.lock:
+            added, self.added = self.added, []
+        for sock, addr, parser, served, since in added:
+            try:
+                selector.register(sock, selectors.EVENT_READ)
+            except (OSError, ValueError) as e: # closed in the meantime, or out of resources
+                print(f"[ERROR] Could not wait for {addr}, closing it: {e}")
+                self.close(sock)
+                continue
+            parked[sock] = (addr, parser, served, since)
+
+    def close(self, sock):
+        sock.close()
+        metrics.connection(-1)
+
+
+# shared cache state, replaced in main() once the command line is parsed
+memoryCache = MemoryCache(0)
+diskCache = None
+upstreamPool = None
+dnsCache = DnsCache(60, 10)
+negativeCache = NegativeCache(5)
+connectTimeout = 5
+upstreamTimeout = 30
+singleFlight = SingleFlight()
+processLocks = ProcessLocks()
+refresher = Refresher(4)
+prefetcher = None # set in main() with --prefetch
+clientIdleTimeout = 15
+clientMaxRequests = 100
+defaultTtl = 0
+staleWhileRevalidate = 0
+compressCache = False
+writeBehind = WriteBehind(0)
+sizeGate = SizeGate(16 * 1024 * 1024, 256 * 1024 * 1024)
+tunnelRelay = TunnelRelay(1024 * 1024, 60)
+idleClients = None # set in main() in threads mode
+tunnelPorts = {443}
+cacheStats = CacheStats(["memory", "disk"])
+metrics = Metrics()
+metricsPath = b"/_proxy/metrics"
+verbose = False
+signalWakeup = None # see watch_signals
+
+# Helper Functions
+
+# parse the command line, server_ip is the only required argument
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="A simple caching proxy server")
+    parser.add_argument("server_ip", help="IP Address of Proxy Server")
+    parser.add_argument("--port", type=int, default=5000, help="port to listen on")
+    parser.add_argument("--mode", choices=["serial", "threads", "asyncio"], default="serial",
+                        help="serve clients one at a time, with a worker pool, or on an asyncio event loop")
+    parser.add_argument("--processes", type=int, default=1,
+                        help="worker processes accepting on the same port, each serving in --mode")
+    parser.add_argument("--workers", type=int, default=8, help="worker threads in threads mode")
+    parser.add_argument("--backlog", type=int, default=16, help="accept backlog and worker queue size")
+    parser.add_argument("--memory-cache-bytes", type=int, default=64 * 1024 * 1024,
+                        help="memory budget for the in-process response cache, 0 disables it")
+    parser.add_argument("--cache-dir", default="cache", help="directory holding cached responses and their index")
+    parser.add_argument("--cache-max-bytes", type=int, default=1024 * 1024 * 1024,
+                        help="total size of the disk cache before entries are evicted")
+    parser.add_argument("--cache-policy", choices=["lru", "lfu"], default="lru",
+                        help="which disk cache entries to evict first")
+    parser.add_argument("--compress", action="store_true",
+                        help="store text bodies gzip'd and send them compressed to clients that accept gzip")
+    parser.add_argument("--write-behind-bytes", type=int, default=32 * 1024 * 1024,
+                        help="body bytes waiting to be written to the disk cache, 0 writes on the serving thread")
+    parser.add_argument("--large-object-bytes", type=int, default=16 * 1024 * 1024,
+                        help="responses larger than this are cached only on their second request")
+    parser.add_argument("--max-object-bytes", type=int, default=256 * 1024 * 1024,
+                        help="responses larger than this are never cached")
+    parser.add_argument("--upstream-max-idle", type=int, default=32,
+                        help="idle origin connections kept for reuse in total, 0 disables pooling")
+    parser.add_argument("--upstream-max-per-host", type=int, default=4, help="idle origin connections kept per host")
+    parser.add_argument("--upstream-idle-timeout", type=float, default=30,
+                        help="seconds an idle origin connection is kept before it is closed")
+    parser.add_argument("--connect-timeout", type=float, default=5,
+                        help="seconds to wait for a connection to an origin")
+    parser.add_argument("--upstream-timeout", type=float, default=30,
+                        help="seconds to wait for each read from an origin")
+    parser.add_argument("--negative-ttl", type=float, default=5,
+                        help="seconds an unreachable origin or an error response is remembered, 0 disables it")
+    parser.add_argument("--dns-ttl", type=float, default=60,
+                        help="seconds a resolved origin address is reused, 0 resolves every new connection")
+    parser.add_argument("--dns-negative-ttl", type=float, default=10,
+                        help="seconds a failed origin lookup is remembered")
+    parser.add_argument("--client-idle-timeout", type=float, default=15,
+                        help="seconds a client connection may sit idle between requests")
+    parser.add_argument("--client-max-requests", type=int, default=100,
+                        help="requests served on one client connection before it is closed")
+    parser.add_argument("--default-ttl", type=float, default=0,
+                        help="seconds a response without any freshness information stays fresh")
+    parser.add_argument("--stale-while-revalidate", type=float, default=60,
+                        help="seconds past expiry a cached response is still served while it is refreshed, 0 disables it")
+    parser.add_argument("--refresh-workers", type=int, default=4,
+                        help="background refreshes of stale responses running at once")
+    parser.add_argument("--prefetch", action="store_true",
+                        help="fetch same-origin stylesheets, scripts and images of HTML pages into the cache")
+    parser.add_argument("--prefetch-workers", type=int, default=4, help="background prefetches running at once")
+    parser.add_argument("--prefetch-queue", type=int, default=256,
+                        help="subresources waiting to be prefetched before more are dropped")
+    parser.add_argument("--tunnel-ports", type=int, nargs="+", default=[443],
+                        help="ports CONNECT may open tunnels to")
+    parser.add_argument("--tunnel-buffer-bytes", type=int, default=1024 * 1024,
+                        help="bytes held for each direction of a CONNECT tunnel")
+    parser.add_argument("--tunnel-idle-timeout", type=float, default=60,
+                        help="seconds a CONNECT tunnel may carry nothing before it is closed")
+    parser.add_argument("--metrics-path", default="/_proxy/metrics",
+                        help='path on the proxy port answering with its metrics, "" turns it off')
+    parser.add_argument("--verbose", action="store_true", help="print every request message and its parsed URL")
+    args = parser.parse_args(argv)
+    if args.client_max_requests < 1:
+        parser.error("--client-max-requests must be at least 1")
+    if args.workers < 1 or args.backlog < 1 or args.refresh_workers < 1 or args.prefetch_workers < 1:
+        parser.error("--workers, --backlog, --refresh-workers and --prefetch-workers must be at least 1")
+    if args.prefetch_queue < 1:
+        parser.error("--prefetch-queue must be at least 1")
+    if args.processes < 1:
+        parser.error("--processes must be at least 1")
+    if args.processes > 1 and not hasattr(os, "fork"):
+        parser.error("--processes needs os.fork, which this platform doesn't have")
+    if args.large_object_bytes > args.max_object_bytes:
+        parser.error("--large-object-bytes must not be larger than --max-object-bytes")
+    if args.memory_cache_bytes < 0 or args.cache_max_bytes < 0 or args.write_behind_bytes < 0:
+        parser.error("cache sizes must not be negative")
+    if args.tunnel_buffer_bytes < 4096:
+        parser.error("--tunnel-buffer-bytes must be at least 4096")
+    return args
+
+
+# split "host" or "host:port" into the name and port to connect to
+def split_host_port(hostname, defaultPort=80):
+    host, sep, port = hostname.rpartition(':')
+    if sep and port.isdigit():
+        return host, int(port)
+    return hostname, defaultPort
+
+
+# Extract hostname and filename from a raw request message
+# returns None for empty messages and the favicon.ico bypass
+def parse_request(message):
+    if len(message.split()) < 2:
+        return None
+    fullURL = message.split()[1][1:].decode() # decode URL into utf-8
+    if fullURL == "favicon.ico":
+        return None
+    hostname = fullURL.partition('/')[0].replace("www.", "", 1)
+    filename = fullURL.partition('/')[2]
+    if verbose:
+        print(f"[INFO] URL: {fullURL}")
+        print(f"[INFO] Host: {hostname} File: {filename}")
+    return hostname, filename
+
+
+# whether message asks for the proxy's own metrics
+def is_metrics_request(message):
+    parts = message.split(None, 2)
+    return bool(metricsPath) and len(parts) > 1 and parts[1] == metricsPath
+
+
+# the complete response for a metrics request
+def metrics_response():
+    body = metrics.render(cacheStats, dnsCache).encode()
+    return (b"HTTP/1.1 200 OK\r\nContent-Type: text/plain; version=0.0.4\r\nCache-Control: no-store\r\n"
+            b"Content-Length: %d\r\n\r\n" % len(body) + body)
+
+
+# the key for hostname/filename in the memory cache
+def cache_key(hostname, filename):
+    return f"{hostname}/{filename}"
+
+
+# look a fresh response up in the memory tier, counting the hit or miss
+# returns the complete response to send, with its Age header
+def memory_lookup(key, acceptsGzip=False):
+    entry = memoryCache.get(key)
+    now = time.time()
+    fresh = entry is not None and entry[2] > now
+    cacheStats.record("memory", fresh)
+    if fresh:
+        print("[CACHE] Memory cache hit")
+        head, body, _, ageBase, identityHead = entry
+        if identityHead is not None and not acceptsGzip:
+            return with_age(identityHead, ageBase, now) + zlib.decompress(body, 31)
+        return with_age(head, ageBase, now) + body
+    return None
+
+
+# look a response up in the disk tier, returns its CacheEntry or None
+# a stale entry is still returned so it can be revalidated, but counts as a miss
+def disk_lookup(key):
+    entry = diskCache.lookup(key)
+    cacheStats.record("disk", entry is not None and entry.expiresAt > time.time())
+    return entry
+
+
+# Cache-Control directives as a dict, directives without a value map to True
+def parse_cache_control(headers):
+    directives = {}
+    for name, value in headers:
+        if name.lower() == "cache-control":
+            for part in value.split(","):
+                directive, sep, argument = part.strip().partition("=")
+                if directive:
+                    directives[directive.lower()] = argument.strip('" ') if sep else True
+    return directives
+
+
+# seconds since the epoch for an HTTP date, or None if it can't be parsed
+def parse_http_date(value):
+    try:
+        parsed = email.utils.parsedate_tz(value)
+        return email.utils.mktime_tz(parsed) if parsed else None
+    except (TypeError, ValueError, OverflowError):
+        return None
+
+
+# how many seconds a response stays fresh after it was generated, or None if it must not be cached
+# explicit max-age wins over Expires; without either, a response with Last-Modified stays fresh
+# for a tenth of its age (at most a day) and anything else for defaultTtl seconds
+def freshness_lifetime(status, headers, now):
+    directives = parse_cache_control(headers)
+    if status not in CACHEABLE_STATUS or "no-store" in directives or "private" in directives:
+        return None
+    if "no-cache" in directives:
+        return 0
+    for directive in ("s-maxage", "max-age"):
+        if directive in directives:
+            try:
+                return max(0, int(directives[directive]))
+            except (TypeError, ValueError):
+                return 0
+    date = parse_http_date(get_header(headers, "Date", "")) or now
+    expires = get_header(headers, "Expires")
+    if expires is not None:
+        expiresAt = parse_http_date(expires)
+        return max(0, expiresAt - date) if expiresAt else 0
+    lastModified = parse_http_date(get_header(headers, "Last-Modified", ""))
+    if lastModified is not None:
+        return min(max(0, date - lastModified) / 10, 86400)
+    return defaultTtl
+
+
+# the time a response received at now stops being fresh, or None if it must not be cached
+def response_expiry(head, now):
+    statusLine, headers = parse_header_block(head)
+    parts = statusLine.split()
+    lifetime = freshness_lifetime(int(parts[1]) if len(parts) > 1 and parts[1].isdigit() else 0, headers, now)
+    if lifetime is None:
+        return None
+    return now + lifetime - initial_age(headers)
+
+
+# the Age the origin reported, how old the response already was when it arrived
+def initial_age(headers):
+    age = get_header(headers, "Age", "0")
+    return int(age) if age.isdigit() else 0
+
+
+# what the index stores about a response besides its body and expiry (see DiskCache.store)
+# the client header block drops the origin's framing and hop-by-hop headers and describes the body of
+# length bytes, so a hit is this block, an Age line and the body file. A body stored gzip'd in
+# storedLength bytes gets a second block, for clients that don't take gzip, describing the decoded body
+def entry_metadata(head, length, now, storedLength=None):
+    statusLine, headers = parse_header_block(head)
+    parts = statusLine.split()
+    kept = [(name, value) for name, value in headers if name.lower() not in HOP_BY_HOP and name.lower() != "age"]
+    identityHead = None
+    if storedLength is None:
+        responseHead = client_head(statusLine, kept, length)
+    else:
+        vary = [token.strip() for name, value in kept if name.lower() == "vary" for token in value.split(",")]
+        kept = [(name, value) for name, value in kept if name.lower() != "vary"]
+        kept.append(("Vary", ", ".join([token for token in vary if token] + ["Accept-Encoding"])))
+        responseHead = client_head(statusLine, kept + [("Content-Encoding", "gzip")], storedLength)
+        identityHead = client_head(statusLine, kept, length)
+    return {
+        "status": int(parts[1]) if len(parts) > 1 and parts[1].isdigit() else 0,
+        "etag": get_header(headers, "ETag"),
+        "last_modified": get_header(headers, "Last-Modified"),
+        "response_head": responseHead,
+        "age_base": now - initial_age(headers),
+        "identity_head": identityHead,
+        "identity_size": length if identityHead is not None else None,
+    }
 
+
+def client_head(statusLine, headers, length):
+    lines = [statusLine] + [f"{name}: {value}" for name, value in headers] + [f"Content-Length: {length}"]
+    return ("\r\n".join(lines) + "\r\n\r\n").encode("latin-1")
+
+
+# whether --compress should store this response's body gzip'd: text that isn't encoded already
+def compressible(response):
+    if get_header(response.headers, "Content-Encoding", "identity").strip().lower() != "identity":
+        return False
+    length = get_header(response.headers, "Content-Length", "")
+    if length.isdigit() and int(length) < 256: # gzip's own overhead eats the gain
+        return False
+    contentType = get_header(response.headers, "Content-Type", "").split(";")[0].strip().lower()
+    return (contentType.startswith("text/") or contentType in COMPRESSIBLE_TYPES
+            or contentType.endswith(("+xml", "+json")))
+
+
+# the body length the origin announced, or None when the body ends with a last chunk or the connection
+def declared_length(response):
+    if response.mode != "length":
+        return None
+    return int(get_header(response.headers, "Content-Length"))
+
+
+# a LinkScanner for an HTML page fetched on a miss when prefetching is on, otherwise None
+def link_scanner(response, hostname, filename):
+    if prefetcher is None or response.status != 200:
+        return None
+    if get_header(response.headers, "Content-Encoding", "identity").strip().lower() != "identity":
+        return None
+    contentType = get_header(response.headers, "Content-Type", "").split(";")[0].strip().lower()
+    if contentType not in ("text/html", "application/xhtml+xml"):
+        return None
+    return LinkScanner(hostname, filename)
+
+
+# the next piece of a gzip'd cache file, decompressed, or b"" once the file is done
+def read_decompressed(f, decompressor):
+    while True:
+        data = f.read(65536)
+        if not data:
+            return decompressor.flush()
+        data = decompressor.decompress(data)
+        if data:
+            return data
+
+
+# a stored client header block with the Age of the response added at the end
+def with_age(responseHead, ageBase, now=None):
+    age = max(0, int((now or time.time()) - ageBase))
+    return responseHead[:-2] + b"Age: %d\r\n\r\n" % age
+
+
+# seconds past its expiry a stored response may still be served while it is refreshed in the background
+# the origin's own stale-while-revalidate wins over the command line, must-revalidate and no-cache forbid it
+def stale_window(head):
+    directives = parse_cache_control(parse_header_block(head)[1])
+    if "must-revalidate" in directives or "proxy-revalidate" in directives or "no-cache" in directives:
+        return 0
+    if "stale-while-revalidate" in directives:
+        try:
+            return max(0, int(directives["stale-while-revalidate"]))
+        except (TypeError, ValueError):
+            return 0
+    return staleWhileRevalidate
+
+
+# whether a stale disk entry is recent enough to be served right away
+def serve_stale(entry):
+    return entry.expiresAt + stale_window(entry.headers) > time.time()
+
+
+# If-None-Match / If-Modified-Since lines that revalidate a stored entry, empty if it has no validators
+def conditional_headers(entry):
+    lines = ""
+    if entry.etag:
+        lines += f"If-None-Match: {entry.etag}\r\n"
+    if entry.lastModified:
+        lines += f"If-Modified-Since: {entry.lastModified}\r\n"
+    return lines.encode("latin-1")
+
+
+# the stored header block updated with the headers of a 304, which replace the stored ones by name
+def merge_headers(storedHead, notModifiedHead):
+    statusLine, stored = parse_header_block(storedHead)
+    _, updates = parse_header_block(notModifiedHead)
+    replaced = {name.lower() for name, _ in updates if name.lower() not in HOP_BY_HOP}
+    merged = [(name, value) for name, value in stored if name.lower() not in replaced]
+    merged += [(name, value) for name, value in updates if name.lower() in replaced]
+    lines = [statusLine] + [f"{name}: {value}" for name, value in merged]
+    return ("\r\n".join(lines) + "\r\n\r\n").encode("latin-1")
+
+
+# the Range and If-Range lines forwarded to the origin for a range of an object that isn't cached
+def range_headers(byteRange):
+    if byteRange is None:
+        return b""
+    value, ifRange = byteRange
+    lines = f"Range: {value}\r\n"
+    if ifRange is not None:
+        lines += f"If-Range: {ifRange}\r\n"
+    return lines.encode("latin-1")
+
+
+# the inclusive (first, last) byte ranges a Range header asks for out of a body of size bytes
+# returns None when the header is to be ignored and the whole body sent, [] when no range is satisfiable
+def parse_range(value, size):
+    unit, _, spec = value.partition("=")
+    if unit.strip().lower() != "bytes":
+        return None
+    ranges = []
+    for part in spec.split(","):
+        first, dash, last = part.strip().partition("-")
+        if not dash or not (first.isdigit() or last.isdigit()) or (first and not first.isdigit()) \
+                or (last and not last.isdigit()):
+            return None
+        if not first: # the last so many bytes
+            if int(last) > 0 and size > 0:
+                ranges.append((max(0, size - int(last)), size - 1))
+            continue
+        first = int(first)
+        last = int(last) if last else None
+        if last is not None and last < first:
+            return None
+        if first < size:
+            ranges.append((first, size - 1 if last is None else min(last, size - 1)))
+    if len(ranges) > MAX_RANGES:
+        return None
+    return ranges
+
+
+# whether the If-Range validator still names the stored entry, only a strong match counts
+def if_range_matches(value, entry):
+    value = value.strip()
+    if value.startswith(('"', 'W/')):
+        return not value.startswith("W/") and value == entry.etag
+    return entry.lastModified is not None and value == entry.lastModified
+
+
+# the byte ranges of a cached entry a request asks for, or None when the whole entry is to be sent
+# an entry stored gzip'd has no byte offsets to cut, it is sent whole
+def requested_ranges(byteRange, entry):
+    if byteRange is None or entry.identityHead is not None:
+        return None
+    if entry.responseHead.split(b" ", 2)[1] != b"200":
+        return None
+    value, ifRange = byteRange
+    if ifRange is not None and not if_range_matches(ifRange, entry):
+        return None
+    return parse_range(value, entry.size)
+
+
+# the answer to a range request of a cached entry: (header block, [(part header, start, count)], trailer)
+# one range is a 206 with a Content-Range, several are a multipart/byteranges body, none is a 416
+def partial_response(entry, ranges):
+    statusLine, headers = parse_header_block(entry.responseHead)
+    if not ranges:
+        head = (f"HTTP/1.1 416 Range Not Satisfiable\r\nContent-Range: bytes */{entry.size}\r\n"
+                f"Content-Length: 0\r\n\r\n").encode("latin-1")
+        return head, [], b""
+    kept = [(name, value) for name, value in headers if name.lower() != "content-length"]
+    status = statusLine.split(" ", 1)[0] + " 206 Partial Content"
+    if len(ranges) == 1:
+        first, last = ranges[0]
+        kept.append(("Content-Range", f"bytes {first}-{last}/{entry.size}"))
+        head = client_head(status, kept, last - first + 1)
+        return with_age(head, entry.ageBase), [(b"", first, last - first + 1)], b""
+    boundary = os.urandom(12).hex()
+    contentType = get_header(headers, "Content-Type")
+    parts = []
+    for first, last in ranges:
+        lines = f"\r\n--{boundary}\r\n"
+        if contentType is not None:
+            lines += f"Content-Type: {contentType}\r\n"
+        lines += f"Content-Range: bytes {first}-{last}/{entry.size}\r\n\r\n"
+        parts.append((lines.encode("latin-1"), first, last - first + 1))
+    trailer = f"\r\n--{boundary}--\r\n".encode("latin-1")
+    kept = [(name, value) for name, value in kept if name.lower() != "content-type"]
+    kept.append(("Content-Type", f"multipart/byteranges; boundary={boundary}"))
+    length = sum(len(prefix) + count for prefix, _, count in parts) + len(trailer)
+    return with_age(client_head(status, kept, length), entry.ageBase), parts, trailer
+
+
+# copy count bytes of an open binary file, from start on, to a socket without passing them through python
+# uses os.sendfile directly on blocking sockets, socket.sendfile handles timeouts and
+# platforms or files where os.sendfile isn't usable
+def send_file(sock, f, count, start=0):
+    offset = 0
+    if hasattr(os, "sendfile") and sock.gettimeout() is None:
+        try:
+            while offset < count:
+                sent = os.sendfile(sock.fileno(), f.fileno(), start + offset, count - offset)
+                if sent == 0: # file shrank underneath us
+                    return offset
+                offset += sent
+            return offset
+        except OSError as e:
+            if offset or e.errno not in (errno.EINVAL, errno.ENOSYS, errno.ENOTSOCK, errno.EOPNOTSUPP):
+                raise
+    return offset + sock.sendfile(f, start + offset, count - offset)
+
+
+# one request taken off a client connection
+class Request:
+    def __init__(self, head, method, target, version, headers, body):
+        self.head = head # raw request line and headers
+        self.method = method
+        self.target = target
+        self.version = version
+        self.headers = headers
+        self.body = body
+
+    # whether Accept-Encoding lists gzip (or *) without q=0
+    def accepts_gzip(self):
+        for coding in get_header(self.headers, "Accept-Encoding", "").split(","):
+            name, _, params = coding.partition(";")
+            if name.strip().lower() in ("gzip", "x-gzip", "*"):
+                q = params.replace(" ", "").lower()
+                try:
+                    return not q.startswith("q=") or float(q[2:]) > 0
+                except ValueError:
+                    return True
+        return False
+
+    # (Range, If-Range or None) of a GET asking for part of the body, or None
+    def byte_range(self):
+        value = get_header(self.headers, "Range")
+        if value is None or self.method != "GET":
+            return None
+        return value, get_header(self.headers, "If-Range")
+
+    # HTTP/1.1 connections stay open unless the client says close, HTTP/1.0 ones only if it asks
+    def keep_alive(self):
+        tokens = [t.strip().lower() for t in get_header(self.headers, "Connection", "").split(",")]
+        if self.version == "HTTP/1.0":
+            return "keep-alive" in tokens
+        return "close" not in tokens
+
+
+# incremental request parser for persistent client connections
+# feed() whatever arrives on the socket, then take complete requests off with next_request()
+# until it returns None; pipelined requests simply queue up in the buffer in order
+class RequestParser:
+    def __init__(self, maxHeadBytes=65536):
+        self.buffer = bytearray()
+        self.maxHeadBytes = maxHeadBytes
+
+    def feed(self, data):
+        self.buffer += data
+
+    # the next complete request, or None if more bytes are needed
+    # raises ValueError for requests this proxy can't frame
+    def next_request(self):
+        # tolerate blank lines between requests
+        while self.buffer.startswith(b"\r\n"):
+            del self.buffer[:2]
+        end = self.buffer.find(b"\r\n\r\n")
+        if end < 0:
+            if len(self.buffer) > self.maxHeadBytes:
+                raise ValueError("request header too large")
+            return None
+        head = bytes(self.buffer[:end + 4])
+        requestLine, headers = parse_header_block(head)
+        parts = requestLine.split()
+        if len(parts) != 3 or not parts[2].startswith("HTTP/"):
+            raise ValueError(f"bad request line {requestLine!r}")
+        if get_header(headers, "Transfer-Encoding") is not None:
+            raise ValueError("chunked request bodies are not supported")
+        length = get_header(headers, "Content-Length", "0")
+        if not length.isdigit():
+            raise ValueError(f"bad Content-Length {length!r}")
+        total = end + 4 + int(length)
+        if len(self.buffer) < total:
+            return None
+        body = bytes(self.buffer[end + 4:total])
+        del self.buffer[:total]
+        return Request(head, parts[0], parts[1], parts[2], headers, body)
+
+
+# incremental parser for one upstream response
+# feed() each block read from the origin and relay the bytes it says belong to the response;
+# the body is framed by Content-Length, by chunked transfer-encoding, or by the origin closing
+# the connection. Body bytes are only counted, chunk framing costs one find() per chunk
+class ResponseParser:
+    def __init__(self, method="GET", maxHeadBytes=65536):
+        self.method = method
+        self.maxHeadBytes = maxHeadBytes
+        self.head = None # raw status line and headers once complete
+        self.interimLen = 0 # bytes of interim 1xx responses skipped before the head
+        self.status = None
+        self.headers = None
+        self.mode = None # "length", "chunked", "close" or "none"
+        self.remaining = 0 # body bytes left in "length" mode, bytes left of the current chunk in "chunked" mode
+        self.chunkState = "size" # "size", "data", "crlf" or "trailer"
+        self.partial = bytearray() # unfinished head or chunk-size/trailer line
+        self.body = [] # decoded body bytes fed since the last take_body(), as memoryviews of the fed data
+        self.done = False
+
+    # consume data, returns how many bytes of it belong to this response
+    # (fewer than len(data) only once the response is done and the origin sent extra bytes)
+    def feed(self, data):
+        pos = 0
+        if self.head is None:
+            pos = self.feed_head(data)
+            if self.head is None:
+                return len(data)
+        if self.mode == "length":
+            take = min(self.remaining, len(data) - pos)
+            self.add_body(data, pos, pos + take)
+            self.remaining -= take
+            pos += take
+            self.done = self.remaining == 0
+        elif self.mode == "chunked":
+            pos = self.feed_chunked(data, pos)
+        elif self.mode == "close":
+            self.add_body(data, pos, len(data))
+            pos = len(data)
+        return pos
+
+    def add_body(self, data, start, end):
+        if end > start:
+            self.body.append(memoryview(data)[start:end])
+
+    # the body bytes decoded since the last call, without any chunk framing
+    def take_body(self):
+        body, self.body = self.body, []
+        return body
+
+    # the origin closed the connection, fine only for close-delimited bodies
+    def eof(self):
+        if self.mode == "close":
+            self.done = True
+        elif not self.done:
+            raise IOError("origin closed the connection in the middle of a response")
+
+    def feed_head(self, data):
+        start = max(len(self.partial) - 3, 0)
+        self.partial += data
+        end = self.partial.find(b"\r\n\r\n", start)
+        if end < 0:
+            if len(self.partial) > self.maxHeadBytes:
+                raise ValueError("response header too large")
+            return len(data)
+        self.head = bytes(self.partial[:end + 4])
+        used = len(data) - (len(self.partial) - (end + 4))
+        self.partial = bytearray()
+        statusLine, self.headers = parse_header_block(self.head)
+        parts = statusLine.split()
+        if len(parts) < 2 or not parts[1].isdigit():
+            raise ValueError(f"bad status line {statusLine!r}")
+        self.status = int(parts[1])
+        if self.status < 200: # interim response (100 Continue, 103 Early Hints), the final one follows
+            self.interimLen += len(self.head)
+            self.head = self.status = self.headers = None
+            return used + self.feed_head(data[used:]) if used < len(data) else used
+        length = get_header(self.headers, "Content-Length")
+        if self.method == "HEAD" or self.status in (204, 304):
+            self.mode = "none"
+            self.done = True
+        elif "chunked" in get_header(self.headers, "Transfer-Encoding", "").lower():
+            self.mode = "chunked"
+        elif length is not None:
+            if not length.strip().isdigit():
+                raise ValueError(f"bad Content-Length {length!r}")
+            self.mode = "length"
+            self.remaining = int(length)
+            self.done = self.remaining == 0
+        else:
+            self.mode = "close"
+        return used
+
+    # walk the chunk framing; chunk data is skipped over in one step
+    def feed_chunked(self, data, pos):
+        while pos < len(data) and not self.done:
+            if self.chunkState == "data":
+                take = min(self.remaining, len(data) - pos)
+                self.add_body(data, pos, pos + take)
+                self.remaining -= take
+                pos += take
+                if self.remaining == 0:
+                    self.chunkState = "crlf"
+                continue
+            # every other state waits for the end of a line
+            end = data.find(b"\n", pos)
+            if end < 0:
+                self.partial += data[pos:]
+                if len(self.partial) > self.maxHeadBytes:
+                    raise ValueError("chunk header too large")
+                return len(data)
+            line = bytes(self.partial + data[pos:end]).strip()
+            self.partial = bytearray()
+            pos = end + 1
+            if self.chunkState == "size":
+                size = line.split(b";")[0].strip()
+                try:
+                    self.remaining = int(size, 16)
+                except ValueError:
+                    raise ValueError(f"bad chunk size {size!r}")
+                self.chunkState = "data" if self.remaining else "trailer"
+            elif self.chunkState == "crlf":
+                self.chunkState = "size"
+            elif not line: # empty line ends the trailer
+                self.done = True
+        return pos
+
+
+# split a raw header block into its first line and a list of (name, value) pairs
+def parse_header_block(block):
+    lines = block.decode("latin-1").split("\r\n")
+    headers = []
+    for line in lines[1:]:
+        name, sep, value = line.partition(":")
+        if sep:
+            headers.append((name.strip(), value.strip()))
+    return lines[0], headers
+
+
+# value of the first header called name (case-insensitive), or default
+def get_header(headers, name, default=None):
+    name = name.lower()
+    for headerName, value in headers:
+        if headerName.lower() == name:
+            return value
+    return default
+
+
+# whether the connection that carried this response may carry another request
+def keeps_alive(block):
+    statusLine, headers = parse_header_block(block)
+    tokens = [t.strip().lower() for t in get_header(headers, "Connection", "").split(",")]
+    if statusLine.startswith("HTTP/1.0"):
+        return "keep-alive" in tokens
+    return bool(statusLine) and "close" not in tokens
+
+
+# an idle pooled socket should have nothing to read, readable means the origin closed it or sent junk
+def socket_is_idle(sock):
+    try:
+        readable, _, _ = select.select([sock], [], [], 0)
+    except (OSError, ValueError):
+        return False
+    return not readable
+
+
+# the GET (or HEAD) sent to the origin, conditional holds extra If-* header lines when revalidating
+def upstream_request(hostname, filename, conditional=b"", method="GET"):
+    return (f"{method} /{filename} HTTP/1.1\r\nHost: {hostname}\r\nConnection: keep-alive\r\n".encode()
+            + conditional + b"\r\n")
+
+
+# a new connection to the origin at hostname, trying each address it resolves to in turn
+def connect_upstream(hostname):
+    error = None
+    start = time.perf_counter()
+    addresses = dnsCache.resolve(*split_host_port(hostname))
+    metrics.observe("dns", time.perf_counter() - start)
+    for family, type, proto, _, address in addresses:
+        c = socket(family, type, proto)
+        c.settimeout(connectTimeout)
+        try:
+            start = time.perf_counter()
+            c.connect(address)
+            metrics.observe("connect", time.perf_counter() - start)
+            c.settimeout(upstreamTimeout)
+            return c
+        except OSError as e:
+            c.close()
+            error = e
+    raise error
+
+
+# send the GET for filename to hostname and read the first block of the response
+# uses an idle pooled connection when there is one; a pooled connection the origin has closed
+# in the meantime fails on the send or returns nothing, and the request is retried
+# once on a new connection (safe, it's a GET or HEAD)
+# failures to connect or to get a response raise UpstreamError
+def open_upstream(hostname, filename, conditional=b"", method="GET"):
+    request = upstream_request(hostname, filename, conditional, method)
+    c = upstreamPool.acquire(hostname)
+    reused = c is not None
+    while True:
+        if c is None:
+            # connect to the host over port 80 (or the port given in the URL)
+            try:
+                c = connect_upstream(hostname)
+            except OSError as e:
+                raise upstream_failed(hostname, filename, e, True) from e
+            print(f"[CONNECT] connecting to {hostname}")
+        else:
+            print(f"[CONNECT] reusing connection to {hostname}")
+        try:
+            start = time.perf_counter()
+            c.sendall(request)
+            data = c.recv(65536)
+            metrics.observe("first_byte", time.perf_counter() - start)
+        except OSError as e:
+            if not reused or isinstance(e, timeout): # a timeout means the origin has the request, don't resend it
+                c.close()
+                raise upstream_failed(hostname, filename, e, False) from e
+            data = b""
+        if data:
+            return c, data
+        c.close()
+        if not reused:
+            raise upstream_failed(hostname, filename, IOError("closed the connection without a response"), False)
+        upstreamPool.record_stale()
+        c = None
+        reused = False
+
+
+# remember a failed attempt to reach the origin and return the UpstreamError to raise
+# a failed connect marks the whole host down, a failed or timed out request only the page
+def upstream_failed(hostname, filename, error, hostDown):
+    status = 504 if isinstance(error, (timeout, asyncio.TimeoutError)) else 502
+    if hostDown:
+        negativeCache.mark_down(hostname, status)
+    else:
+        negativeCache.put_response(cache_key(hostname, filename), GATEWAY_ERRORS[status], True)
+    return UpstreamError(hostname, status, error)
+
+
+# (raw response, whether it is delimited) to answer key with if it or its origin failed recently, or None
+def negative_lookup(hostname, key):
+    response = negativeCache.response(key)
+    if response is None:
+        status = negativeCache.host_down(hostname)
+        if status is None:
+            return None
+        response = GATEWAY_ERRORS[status], True
+    print("[CACHE] Failed recently, answering without contacting the origin")
+    cacheStats.count("negative hits")
+    return response
+
+
+# whether an error response from the origin is remembered in the negative cache
+def negative_cacheable(response):
+    return response.status >= 400 and "no-store" not in parse_cache_control(response.headers)
+
+
+# serve requests on a client connection until the client closes it, sends Connection: close,
+# goes quiet for clientIdleTimeout seconds or reaches clientMaxRequests
+# pipelined requests are answered one after the other in the order they arrived
+# with idleClients, a connection with nothing to read is parked there instead of waiting in recv(),
+# and comes back here with its parser and request count once it is readable
+# closes the client socket unless it was parked
+def handle_client(tcpCliSock, addr, parser=None, served=0):
+    if parser is None:
+        parser = RequestParser()
+        metrics.connection(1)
+        print(f"[CONN] Received connection from: {addr}")
+    parked = False
+    try:
+        tcpCliSock.settimeout(clientIdleTimeout)
+        while served < clientMaxRequests:
+            start = time.perf_counter()
+            try:
+                request = parser.next_request()
+            except ValueError as e:
+                print(f"[ERROR] Bad request from {addr}: {e}")
+                tcpCliSock.sendall(BAD_REQUEST)
+                return
+            if request is None:
+                if idleClients is not None and not readable_now(tcpCliSock):
+                    idleClients.park(tcpCliSock, addr, parser, served)
+                    parked = True
+                    return
+                data = tcpCliSock.recv(65536)
+                if not data: # client closed the connection
+                    return
+                parser.feed(data)
+                continue
+            served += 1
+            metrics.observe("parse", time.perf_counter() - start)
+            if request.method == "CONNECT":
+                open_tunnel(tcpCliSock, request.target, bytes(parser.buffer))
+                return
+            if request.method not in ("GET", "HEAD"):
+                print(f"[ERROR] Can't forward {request.method} from {addr}")
+                tcpCliSock.sendall(NOT_IMPLEMENTED)
+                return
+            start = time.perf_counter()
+            if request.method == "HEAD":
+                framed = serve_head(tcpCliSock, request.head, request.accepts_gzip())
+            else:
+                framed = serve_request(tcpCliSock, request.head, request.accepts_gzip(), request.byte_range())
+            metrics.observe("request", time.perf_counter() - start)
+            if not framed:
+                return # the response could only be ended by closing the connection
+            if not request.keep_alive():
+                return
+
+    except timeout:
+        print(f"[CONN] Closing idle connection from {addr}")
+
+    except Exception as e:
+        print(f"[ERROR] Exception while serving {addr}:\n{e}")
+
+    finally:
+        if not parked:
+            # Close client socket
+            tcpCliSock.close()
+            metrics.connection(-1)
+        if verbose:
+            print(f"[STATS] {cacheStats.summary()}")
+
+
+# whether sock has bytes (or the client's close) waiting, without blocking
+def readable_now(sock):
+    if hasattr(select, "poll"): # select() can't take descriptors above FD_SETSIZE
+        poller = select.poll()
+        poller.register(sock, select.POLLIN)
+        return bool(poller.poll(0))
+    return bool(select.select([sock], [], [], 0)[0])
+
+
+# the host:port a CONNECT asks for, or None when it has no port or the port isn't in tunnelPorts
+def tunnel_target(target):
+    host, sep, port = target.rpartition(":")
+    if not host or not port.isdigit() or int(port) not in tunnelPorts:
+        return None
+    return target
+
+
+# answer a CONNECT: connect to the origin, confirm the tunnel and hand both sockets to tunnelRelay,
+# which carries the bytes (usually TLS) both ways from then on. leftover is whatever the client
+# sent after the CONNECT request, it goes to the origin first
+def open_tunnel(tcpCliSock, target, leftover):
+    hostname = tunnel_target(target)
+    if hostname is None:
+        print(f"[ERROR] Refusing tunnel to {target}")
+        tcpCliSock.sendall(FORBIDDEN)
+        return
+    status = negativeCache.host_down(hostname)
+    if status is not None:
+        tcpCliSock.sendall(GATEWAY_ERRORS[status])
+        return
+    try:
+        upstream = connect_upstream(hostname)
+    except OSError as e:
+        print(f"[ERROR] Could not open a tunnel to {hostname}: {e}")
+        tcpCliSock.sendall(GATEWAY_ERRORS[upstream_failed(hostname, "", e, True).status])
+        return
+    print(f"[CONNECT] tunnel to {hostname}")
+    cacheStats.count("tunnels opened")
+    try:
+        tcpCliSock.sendall(TUNNEL_ESTABLISHED)
+        if leftover:
+            upstream.sendall(leftover)
+    except OSError:
+        upstream.close()
+        raise
+    tunnelRelay.add(tcpCliSock.dup(), upstream) # the caller closes its own descriptor
+
+
+# answer one request on the client socket
+# returns True when the client can tell where the response ended, so the connection may carry another one
+def serve_request(tcpCliSock, message, acceptsGzip=False, byteRange=None):
+    if verbose:
+        print(f"[MESSAGE] Message received: \n{message}")
+    if is_metrics_request(message):
+        tcpCliSock.sendall(metrics_response())
+        return True
+    target = parse_request(message)
+    if target is None:
+        tcpCliSock.sendall(NOT_FOUND)
+        return True
+    hostname, filename = target
+    key = cache_key(hostname, filename)
+
+    # a second pass only happens after following a fetch that sent nothing (a 304, a failure or
+    # a response too large to share, which is looked up again once it is in the cache)
+    for coalesce in (True, False):
+        # the hottest responses are held in memory, ready to send
+        start = time.perf_counter()
+        response = memory_lookup(key, acceptsGzip) if byteRange is None else None # ranges are cut from files
+        if response is not None:
+            metrics.observe("lookup", time.perf_counter() - start)
+            tcpCliSock.sendall(response)
+            metrics.served("memory", len(response))
+            return True
+
+        # Check to see if the file is in the cache
+        entry = disk_lookup(key)
+        metrics.observe("lookup", time.perf_counter() - start)
+        if entry is not None and entry.expiresAt > time.time():
+            framed = serve_cached(tcpCliSock, key, entry, acceptsGzip, byteRange)
+            if framed is not None:
+                return framed
+            entry = None
+
+        # recently expired: answer from the cache now and revalidate in the background
+        if entry is not None and serve_stale(entry):
+            framed = serve_cached(tcpCliSock, key, entry, acceptsGzip, byteRange)
+            if framed is not None:
+                print("[CACHE] Served stale copy, refreshing in the background")
+                cacheStats.count("stale served")
+                refresher.submit(key, lambda: refresh_entry(hostname, filename, key, entry))
+                return framed
+            entry = None
+
+        # a page or origin that failed moments ago fails again right away, unless there is a stale copy
+        failure = negative_lookup(hostname, key)
+        if failure is not None:
+            framed = serve_cached(tcpCliSock, key, entry, acceptsGzip, byteRange) if entry is not None else None
+            if framed is not None:
+                return framed
+            tcpCliSock.sendall(failure[0])
+            metrics.served("negative", len(failure[0]))
+            return failure[1]
+
+        # only one request per key goes to the origin, the rest stream its response as it arrives
+        # a range of something not cached is asked from the origin as it is, on its own
+        rangeHeaders = range_headers(byteRange) if entry is None else b""
+        flight, leader = singleFlight.join(key) if coalesce and not rangeHeaders else (None, True)
+        if not leader:
+            print("[CACHE] Following an in-flight fetch")
+            cacheStats.count("coalesced")
+            framed = follow_flight(tcpCliSock, flight)
+            if framed is not None:
+                return framed
+            continue
+
+        lock = None
+        try:
+            # another worker process may be fetching it already, then serve what it cached
+            lock, waited = processLocks.acquire(key, connectTimeout + upstreamTimeout)
+            fetched = diskCache.lookup(key) if waited else None
+            if fetched is not None and fetched.expiresAt > time.time():
+                framed = serve_cached(tcpCliSock, key, fetched, acceptsGzip, byteRange)
+                if framed is not None:
+                    cacheStats.count("fetched by another process")
+                    return framed
+
+            conditional = conditional_headers(entry) if entry is not None else b""
+            if conditional:
+                print("[CACHE] Cache entry is stale, revalidating")
+            else:
+                print("[CACHE] Cache miss")
+            response, framed = relay_upstream(tcpCliSock, hostname, filename, key, conditional, flight, rangeHeaders)
+            if conditional and response.status == 304:
+                framed = serve_cached(tcpCliSock, key, revalidated(key, entry, response.head), acceptsGzip, byteRange)
+                if framed is None: # lost the file in the meantime, fetch it again
+                    response, framed = relay_upstream(tcpCliSock, hostname, filename, key, flight=flight)
+            return framed
+        except UpstreamError as e:
+            print(f"[ERROR] Upstream failure:\n{e}")
+            framed = serve_cached(tcpCliSock, key, entry, acceptsGzip, byteRange) if entry is not None else None
+            if framed is not None:
+                return framed
+            tcpCliSock.sendall(GATEWAY_ERRORS[e.status])
+            return True
+        except Exception as e:
+            print(f"[ERROR] Exception:\n{e}")
+            return False
+        finally:
+            processLocks.release(lock)
+            if flight is not None:
+                singleFlight.land(key, flight)
+    return False
+
+
+# answer a HEAD: the header block of a fresh cached entry, otherwise whatever the origin answers
+# to a HEAD of its own, which is relayed and not cached
+# returns True when the client can tell where the response ended
+def serve_head(tcpCliSock, message, acceptsGzip=False):
+    if is_metrics_request(message):
+        response = metrics_response()
+        tcpCliSock.sendall(response[:response.index(b"\r\n\r\n") + 4])
+        return True
+    target = parse_request(message)
+    if target is None:
+        tcpCliSock.sendall(NOT_FOUND)
+        return True
+    hostname, filename = target
+    head = cached_head(cache_key(hostname, filename), acceptsGzip)
+    if head is not None:
+        tcpCliSock.sendall(head)
+        metrics.served("disk", len(head))
+        return True
+    status = negativeCache.host_down(hostname)
+    if status is not None:
+        tcpCliSock.sendall(GATEWAY_ERRORS[status])
+        return True
+    c = None
+    try:
+        c, data = open_upstream(hostname, filename, method="HEAD")
+        response = ResponseParser("HEAD")
+        while True:
+            used = response.feed(data)
+            if response.done:
+                break
+            data = c.recv(65536)
+            if not data:
+                return False
+        tcpCliSock.sendall(response.head)
+        metrics.served("origin", len(response.head))
+        if used == len(data) and keeps_alive(response.head):
+            upstreamPool.release(hostname, c)
+            c = None
+        return True
+    except UpstreamError as e:
+        print(f"[ERROR] Upstream failure:\n{e}")
+        tcpCliSock.sendall(GATEWAY_ERRORS[e.status])
+        return True
+    finally:
+        if c:
+            c.close()
+
+
+# the header block, with an Age line, of a fresh disk entry for key, or None
+def cached_head(key, acceptsGzip=False):
+    entry = disk_lookup(key)
+    if entry is None or entry.expiresAt <= time.time():
+        return None
+    print("[CACHE] Cache hit, sending the header block")
+    decompress = entry.identityHead is not None and not acceptsGzip
+    return with_age(entry.identityHead if decompress else entry.responseHead, entry.ageBase)
+
+
+# revalidate or refetch a stale entry with no client waiting, skipped if the key is already being fetched
+def refresh_entry(hostname, filename, key, entry):
+    flight, leader = singleFlight.join(key)
+    if not leader:
+        return
+    lock = processLocks.try_acquire(key) # None while another worker process refreshes it
+    try:
+        if lock is None:
+            return
+        conditional = conditional_headers(entry)
+        response, _ = relay_upstream(None, hostname, filename, key, conditional, flight)
+        if conditional and response.status == 304:
+            revalidated(key, entry, response.head)
+        cacheStats.count("background refreshes")
+        print(f"[CACHE] Refreshed {key} in the background")
+    except Exception as e:
+        print(f"[ERROR] Background refresh of {key} failed:\n{e}")
+    finally:
+        processLocks.release(lock)
+        singleFlight.land(key, flight)
+
+
+# fetch a subresource into the cache with no client waiting, unless it is cached, known to fail
+# or already being fetched
+def prefetch(hostname, filename):
+    key = cache_key(hostname, filename)
+    if diskCache.is_fresh(key) or negativeCache.response(key) or negativeCache.host_down(hostname):
+        return
+    flight, leader = singleFlight.join(key)
+    if not leader:
+        return
+    lock = processLocks.try_acquire(key) # None while another worker process fetches it
+    try:
+        if lock is None:
+            return
+        relay_upstream(None, hostname, filename, key, flight=flight)
+        cacheStats.count("prefetched")
+    except Exception as e:
+        print(f"[ERROR] Prefetch of {key} failed:\n{e}")
+    finally:
+        processLocks.release(lock)
+        singleFlight.land(key, flight)
+
+
+# stream another request's fetch to this client from its first byte
+# returns whether the response was delimited, or None if the leader relayed nothing or the response
+# was too large to share, after it has gone to the cache if it was going there. False when the
+# client fell too far behind a large response and was cut off
+def follow_flight(tcpCliSock, flight):
+    index = 0
+    done = False
+    while not done:
+        blocks, done = flight.read(index)
+        if blocks is None:
+            if index:
+                print("[CACHE] Fell too far behind an in-flight fetch, closing the connection")
+                return False
+            break
+        for data in blocks:
+            tcpCliSock.sendall(data)
+            metrics.served("coalesced", len(data))
+        index += len(blocks)
+    if not index:
+        flight.settle()
+    return flight.framed if index else None
+
+
+# send a cached entry to the client: its stored header block with an Age line, then the body
+# a gzip'd body goes out as stored to clients that accept gzip and decompressed to the rest
+# byteRange is the request's (Range, If-Range), the ranges it asks for are cut from the file
+# returns True, or None when the file has disappeared behind the index's back
+def serve_cached(tcpCliSock, key, entry, acceptsGzip=False, byteRange=None):
+    print(f"[CACHE] Opening file {entry.path}")
+    try:
+        f = open(entry.path, "rb")
+    except IOError:
+        diskCache.discard(key, entry.path)
+        return None
+    with f:
+        print("[CACHE] Cache hit")
+        ranges = requested_ranges(byteRange, entry)
+        if ranges is not None:
+            head, parts, trailer = partial_response(entry, ranges)
+            tcpCliSock.sendall(head)
+            for prefix, start, count in parts:
+                tcpCliSock.sendall(prefix)
+                send_file(tcpCliSock, f, count, start)
+            tcpCliSock.sendall(trailer)
+            served_ranges(head, parts, trailer)
+            return True
+
+        # Proxy finds a cache hit and generates a response
+        decompress = entry.identityHead is not None and not acceptsGzip
+        head = with_age(entry.identityHead if decompress else entry.responseHead, entry.ageBase)
+        if len(entry.responseHead) + entry.size <= memoryCache.maxEntryBytes:
+            # small enough to promote into the memory cache, read it in one go
+            body = f.read()
+            memoryCache.put(key, entry.responseHead, body, entry.expiresAt, entry.ageBase, entry.identityHead)
+            tcpCliSock.sendall(head + (zlib.decompress(body, 31) if decompress else body))
+        elif decompress:
+            tcpCliSock.sendall(head)
+            decompressor = zlib.decompressobj(31)
+            while True:
+                data = read_decompressed(f, decompressor)
+                if not data:
+                    break
+                tcpCliSock.sendall(data)
+        else:
+            # send the header in one buffer, then let the kernel copy the file
+            tcpCliSock.sendall(head)
+            send_file(tcpCliSock, f, entry.size)
+    metrics.served("disk", len(head) + (entry.identitySize if decompress else entry.size))
+    print("[CACHE] Read from cache")
+    return True
+
+
+# count a range response sent from a cache file
+def served_ranges(head, parts, trailer):
+    metrics.served("disk", len(head) + sum(len(prefix) + count for prefix, _, count in parts) + len(trailer))
+    cacheStats.count("ranges served" if parts else "ranges not satisfiable")
+    print(f"[CACHE] Sent {len(parts)} byte range(s) from cache")
+
+
+# the origin answered a revalidation with 304: store the merged headers and new expiry
+# and return the refreshed disk entry
+def revalidated(key, entry, notModifiedHead):
+    print("[CACHE] Not modified, serving cached copy")
+    cacheStats.count("revalidated")
+    now = time.time()
+    headers = merge_headers(entry.headers, notModifiedHead)
+    expiresAt = response_expiry(headers, now) or 0
+    if entry.identityHead is None:
+        metadata = entry_metadata(headers, entry.size, now)
+    else:
+        metadata = entry_metadata(headers, entry.identitySize, now, entry.size)
+    diskCache.freshen(key, headers, expiresAt, metadata)
+    return entry._replace(headers=headers, expiresAt=expiresAt, responseHead=metadata["response_head"],
+                          ageBase=metadata["age_base"], etag=metadata["etag"], lastModified=metadata["last_modified"],
+                          identityHead=metadata["identity_head"])
+
+
+# writes a response body into a new cache file, gzip'd if compress, while keeping a copy of what is
+# written for the memory cache as long as it is small enough
+# the relay calls write, close, commit and abort; they queue the work on writeBehind, which runs it
+# (the *_now methods) in order on its writer thread. If writeBehind has no room for a piece of the
+# body the response is dropped from the cache, the relay carries on sending it to the client
+class CacheWriter:
+    def __init__(self, key, compress):
+        self.key = key
+        self.file = None # opened by the first piece written
+        self.path = None
+        self.compressor = zlib.compressobj(6, zlib.DEFLATED, 31) if compress else None
+        self.gzipped = compress
+        self.chunks = []
+        self.bodyLen = 0 # decoded body bytes
+        self.storedLen = 0 # bytes written to the file
+        self.elapsed = 0.0 # seconds spent writing, reported on commit
+        self.dropped = False # set on the relay's side
+        self.failed = False # set on the writer's side
+        self.finished = False
+
+    def write(self, body):
+        if self.dropped or not body:
+            return
+        size = sum(len(part) for part in body)
+        if not writeBehind.submit(size, self.write_now, body):
+            print(f"[CACHE] Write-behind queue full, not caching {self.key}")
+            cacheStats.count("cache writes dropped")
+            self.abort()
+
+    # the body is complete
+    def close(self):
+        if not self.dropped:
+            writeBehind.submit(0, self.close_now)
+
+    # index the file in the disk cache and put the copy in the memory cache once both are written
+    # with the flight that fetched the response, it stays joinable until then
+    def commit(self, head, expiresAt, now, flight=None):
+        if not self.dropped:
+            self.finished = True
+            if flight is not None:
+                flight.writing = True
+            writeBehind.submit(0, self.commit_now, head, expiresAt, now, flight)
+
+    # drop an unfinished body, never keep a partial response
+    def abort(self):
+        if not self.dropped and not self.finished:
+            self.dropped = True
+            writeBehind.submit(0, self.abort_now)
+
+    def write_now(self, body):
+        if self.failed:
+            return
+        start = time.perf_counter()
+        try:
+            if self.file is None:
+                self.file, self.path = diskCache.create(self.key)
+            for part in body:
+                self.bodyLen += len(part)
+                self.store(self.compressor.compress(part) if self.compressor else part)
+        except OSError as e:
+            self.fail(e)
+        self.elapsed += time.perf_counter() - start
+
+    def store(self, data):
+        self.file.write(data)
+        self.storedLen += len(data)
+        if self.chunks is not None:
+            self.chunks.append(data)
+            if self.storedLen > memoryCache.maxEntryBytes:
+                self.chunks = None # too big to keep in memory
+
+    def close_now(self):
+        if self.failed:
+            return
+        start = time.perf_counter()
+        try:
+            if self.file is None: # empty body
+                self.file, self.path = diskCache.create(self.key)
+            if self.compressor:
+                self.store(self.compressor.flush())
+                self.compressor = None
+            self.file.close()
+        except OSError as e:
+            self.fail(e)
+        self.elapsed += time.perf_counter() - start
+
+    def commit_now(self, head, expiresAt, now, flight):
+        try:
+            if self.failed:
+                return
+            start = time.perf_counter()
+            metadata = entry_metadata(head, self.bodyLen, now, self.storedLen if self.gzipped else None)
+            diskCache.store(self.key, self.path, head, expiresAt, metadata)
+            self.path = None
+            if self.chunks is not None:
+                memoryCache.put(self.key, metadata["response_head"], b"".join(self.chunks), expiresAt,
+                                metadata["age_base"], metadata["identity_head"])
+            metrics.observe("cache_write", self.elapsed + time.perf_counter() - start)
+        finally:
+            if flight is not None:
+                singleFlight.written(self.key, flight)
+
+    def abort_now(self):
+        if self.path is not None:
+            self.file.close()
+            diskCache.remove_file(self.path)
+            self.path = None
+
+    # the disk failed us, forget about caching this response
+    def fail(self, error):
+        if not self.failed:
+            print(f"[ERROR] Writing the cache file for {self.key} failed:\n{error}")
+            cacheStats.count("cache writes failed")
+            self.failed = True
+            self.abort_now()
+
+
+# relay one origin response: parse it, decide from its header block whether it is cached, bypassed
+# for its size, remembered in the negative cache and shared with the flight's followers, write the
+# cache file and scan for links. Only the I/O is left to relay_upstream and relay_upstream_async,
+# which drive this generator: it yields what it needs done and is sent the outcome
+#   ("read",)                -> the next block from the origin, b"" once the origin has closed
+#   ("send", data)           -> None once data went to the client
+#   ("index", function, *args) -> function(*args), a disk index call that may wait for other processes
+# an error doing any of these is thrown in. data is what the origin sent first, client is False for
+# background fetches. Returns (the ResponseParser, whether the client can tell where the response
+# ended, whether the origin connection can carry another request)
+def relay_response(hostname, filename, key, data, conditional=b"", flight=None, rangeHeaders=b"", client=True):
+    now = time.time()
+    start = time.perf_counter()
+    clientGone = not client
+    errorCopy = None # copy of an error response for the negative cache
+    errorLen = 0
+    cacheWriter = None
+    response = ResponseParser()
+    notModified = False
+    scanner = None # finds subresources to prefetch in HTML pages
+    large = False # above sizeGate.largeBytes: not shared through the flight, maybe not cached
+    bypassed = False # not cached for its size
+    bodyLen = 0
+    held = [] # blocks read before the header block was complete
+    try:
+        # relay whole blocks as they arrive, the parser finds where the response ends
+        while True:
+            used = response.feed(data)
+            excess = used < len(data)
+            if excess:
+                data = data[:used]
+            if held is not None:
+                held.append(data)
+                if response.head is not None:
+                    # the header block decides whether the response is relayed and cached
+                    data = b"".join(held)[response.interimLen:] # interim responses aren't relayed
+                    held = None
+                    notModified = bool(conditional) and response.status == 304
+                    if not notModified:
+                        scanner = link_scanner(response, hostname, filename)
+                        expiresAt = response_expiry(response.head, now)
+                        length = declared_length(response)
+                        large = length is not None and length > sizeGate.largeBytes
+                        again = flight is not None and flight.followers > 0
+                        if expiresAt is None:
+                            # the origin doesn't let us cache it, a part of the body says nothing about the whole
+                            if response.status != 206 and diskCache.might_have(key):
+                                yield "index", diskCache.discard, key
+                            if negative_cacheable(response) and not rangeHeaders:
+                                errorCopy = []
+                        elif large and not (yield "index", sizeGate.admit, key, length, again):
+                            bypassed = True
+                            print(f"[CACHE] {key} is too large to cache now, streaming it through")
+                            cacheStats.count("large objects bypassed")
+                        else:
+                            # Create a new file in the cache for the requested file
+                            cacheWriter = CacheWriter(key, compressCache and compressible(response))
+                        # followers wait for the copy going to the cache, or fetch a bypassed one themselves
+                        if large and flight is not None and flight.abandon(cacheWriter is not None) and not cacheWriter:
+                            flight = None
+            if held is None and not notModified:
+                # send the response to the client and any followers
+                if errorCopy is not None:
+                    errorCopy.append(data)
+                    errorLen += len(data)
+                    if errorLen > negativeCache.MAX_RESPONSE_BYTES:
+                        errorCopy = None
+                if flight is not None:
+                    flight.publish(data)
+                if not clientGone:
+                    try:
+                        yield "send", data
+                        metrics.served("origin", len(data))
+                    except OSError:
+                        # keep fetching for the cache and any followers
+                        clientGone = flight is not None
+                        if not clientGone:
+                            raise
+            # the cache keeps the decoded body, the client gets the response as the origin framed it
+            body = response.take_body()
+            size = sum(len(part) for part in body)
+            bodyLen += size
+            if bypassed:
+                metrics.bypassed(size)
+            elif not large and bodyLen > sizeGate.largeBytes: # no length announced, it turned out large
+                large = True
+                again = flight is not None and flight.followers > 0
+                if cacheWriter is not None and not (yield "index", sizeGate.admit, key, bodyLen, again):
+                    bypassed = True
+            if cacheWriter is not None and (bypassed or bodyLen > sizeGate.maxBytes):
+                print(f"[CACHE] {key} is too large to cache now, streaming it through")
+                cacheStats.count("large objects bypassed")
+                metrics.bypassed(bodyLen)
+                cacheWriter.abort()
+                cacheWriter = None
+                bypassed = True
+            if large and flight is not None and flight.abandon(cacheWriter is not None) and not cacheWriter:
+                flight = None
+            if cacheWriter is not None:
+                cacheWriter.write(body)
+            if scanner is not None:
+                scanner.scan(body)
+            if response.done:
+                break
+            data = yield ("read",)
+            if not data: # the origin closed the connection
+                response.eof()
+                break
+
+        metrics.observe("transfer", time.perf_counter() - start)
+        framed = response.mode != "close"
+        if cacheWriter:
+            cacheWriter.close()
+            cacheWriter.commit(response.head, expiresAt, now, flight)
+        if errorCopy is not None:
+            negativeCache.put_response(key, b"".join(errorCopy), framed)
+        if flight is not None:
+            flight.framed = framed
+        # the connection can carry another request if the response ended where the origin said it would
+        return response, framed and not clientGone, framed and not excess and keeps_alive(response.head)
+    finally:
+        if cacheWriter:
+            cacheWriter.abort()
+
+
+# fetch filename from the origin and relay the response to the client while writing it to the cache
+# with conditional headers a 304 is not relayed, the caller serves its cached copy instead
+# returns (the ResponseParser, whether the client can tell where the response ended)
+def relay_upstream(tcpCliSock, hostname, filename, key, conditional=b"", flight=None, rangeHeaders=b""):
+    c = None
+    steps = None
+    try:
+        # ask the origin for the file on a pooled or new connection
+        c, data = open_upstream(hostname, filename, conditional + rangeHeaders)
+        steps = relay_response(hostname, filename, key, data, conditional, flight, rangeHeaders, tcpCliSock is not None)
+        step = next(steps)
+        while True:
+            try:
+                if step[0] == "read":
+                    outcome = c.recv(65536)
+                elif step[0] == "send":
+                    outcome = tcpCliSock.sendall(step[1])
+                else:
+                    outcome = step[1](*step[2:])
+            except Exception as e:
+                step = steps.throw(e)
+            else:
+                step = steps.send(outcome)
+    except StopIteration as finished:
+        response, framed, reusable = finished.value
+        if reusable:
+            upstreamPool.release(hostname, c)
+            c = None
+        return response, framed
+    finally:
+        if steps is not None:
+            steps.close()
+        # close connection
+        if c:
+            c.close()
+
+
+# make SIGINT and SIGTERM wake accept_client: the kernel may hand a signal to any thread, and
+# one that lands on a worker thread doesn't interrupt the main thread's accept(), which is where
+# python runs the handler. Returns a socket pair, a byte arrives on the first with each signal
+def watch_signals(tcpSerSock):
+    pair = socketpair()
+    for sock in pair:
+        sock.setblocking(False)
+    signal.set_wakeup_fd(pair[1].fileno())
+    tcpSerSock.setblocking(False) # other worker processes may take a client select() announced
+    return pair
+
+
+# the next client of the listening socket, on the main thread
+def accept_client(tcpSerSock):
+    while True:
+        readable, _, _ = select.select([tcpSerSock, signalWakeup[0]], [], [])
+        if signalWakeup[0] in readable:
+            signalWakeup[0].recv(64) # the handler runs here, before the next line
+        if tcpSerSock in readable:
+            try:
+                return tcpSerSock.accept()
+            except BlockingIOError: # another worker process took it
+                pass
+
+
+# the original loop: accept a client, serve it completely, then accept the next one
+def serve_serial(tcpSerSock):
     # while the socket is open, keep receiving requests
     while tcpSerSock:
         # start receiving data from the client
         print("[STARTUP] Ready to accept requests")
-        tcpCliSock, addr = tcpSerSock.accept() # accept a request from client
+        tcpCliSock, addr = accept_client(tcpSerSock) # accept a request from client
+        handle_client(tcpCliSock, addr)
+
+
+# worker thread body: take clients off the queue forever, newly accepted ones as (socket, address)
+# and ones idleClients hands back with their parser and request count as well
+def worker_loop(clients):
+    while True:
+        handle_client(*clients.get())
+        clients.task_done()
+
+
+# accept clients on the main thread and hand them to a fixed pool of workers
+# the queue is bounded, so when every worker is busy and the queue is full
+# accept() stops being called and new clients wait in the kernel backlog instead
+def serve_threaded(tcpSerSock, workers, backlog):
+    clients = queue.Queue(maxsize=backlog)
+    idleClients.start(clients)
+    for i in range(workers):
+        threading.Thread(target=worker_loop, args=(clients,), name=f"worker-{i}", daemon=True).start()
+    print(f"[STARTUP] Started {workers} workers, backlog {backlog}")
+
+    while tcpSerSock:
+        print("[STARTUP] Ready to accept requests")
+        tcpCliSock, addr = accept_client(tcpSerSock)
+        clients.put((tcpCliSock, addr)) # blocks while the queue is full
+
+
+# asyncio version of connect_upstream
+async def connect_upstream_async(hostname):
+    error = None
+    start = time.perf_counter()
+    addresses = await dnsCache.resolve_async(*split_host_port(hostname))
+    metrics.observe("dns", time.perf_counter() - start)
+    for family, _, _, _, address in addresses:
+        try:
+            start = time.perf_counter()
+            conn = await asyncio.wait_for(asyncio.open_connection(address[0], address[1], family=family),
+                                          connectTimeout)
+            metrics.observe("connect", time.perf_counter() - start)
+            return conn
+        except (OSError, asyncio.TimeoutError) as e:
+            error = e
+    raise error
+
+
+# asyncio version of open_upstream: send the GET on a pooled or new connection and read the first block
+async def open_upstream_async(hostname, filename, conditional=b"", method="GET"):
+    request = upstream_request(hostname, filename, conditional, method)
+    conn = upstreamPool.acquire(hostname)
+    reused = conn is not None
+    while True:
+        if conn is None:
+            try:
+                conn = await connect_upstream_async(hostname)
+            except (OSError, asyncio.TimeoutError) as e:
+                raise upstream_failed(hostname, filename, e, True) from e
+            print(f"[CONNECT] connecting to {hostname}")
+        else:
+            print(f"[CONNECT] reusing connection to {hostname}")
+        upReader, upWriter = conn
+        try:
+            start = time.perf_counter()
+            upWriter.write(request)
+            await upWriter.drain()
+            data = await asyncio.wait_for(upReader.read(65536), upstreamTimeout)
+            metrics.observe("first_byte", time.perf_counter() - start)
+        except (OSError, asyncio.TimeoutError) as e:
+            upWriter.close()
+            if not reused or isinstance(e, asyncio.TimeoutError):
+                raise upstream_failed(hostname, filename, e, False) from e
+            data = b""
+        except BaseException:
+            upWriter.close()
+            raise
+        if data:
+            return upReader, upWriter, data
+        upWriter.close()
+        if not reused:
+            raise upstream_failed(hostname, filename, IOError("closed the connection without a response"), False)
+        # a pooled connection the origin closed in the meantime, retry once on a new one
+        upstreamPool.record_stale()
+        conn = None
+        reused = False
+
+
+# a pooled (reader, writer) pair is usable if the origin hasn't closed it
+def stream_is_idle(conn):
+    upReader, upWriter = conn
+    return not upReader.at_eof() and not upWriter.is_closing()
+
+
+# asyncio version of relay_upstream: drives relay_response with stream reads and writes, and runs
+# its index calls in the default executor so a busy index never holds up the event loop
+# returns (the ResponseParser, whether the client can tell where the response ended)
+async def relay_upstream_async(writer, hostname, filename, key, conditional=b"", flight=None, rangeHeaders=b""):
+    upReader, upWriter, data = await open_upstream_async(hostname, filename, conditional + rangeHeaders)
+    loop = asyncio.get_running_loop()
+    steps = relay_response(hostname, filename, key, data, conditional, flight, rangeHeaders, writer is not None)
+    try:
+        step = next(steps)
+        while True:
+            try:
+                if step[0] == "read":
+                    outcome = await asyncio.wait_for(upReader.read(65536), upstreamTimeout)
+                elif step[0] == "send":
+                    writer.write(step[1])
+                    outcome = await writer.drain() # wait here if the client reads slower than the origin sends
+                else:
+                    outcome = await loop.run_in_executor(None, step[1], *step[2:])
+            except Exception as e:
+                step = steps.throw(e)
+            else:
+                step = steps.send(outcome)
+    except StopIteration as finished:
+        response, framed, reusable = finished.value
+        if reusable:
+            upstreamPool.release(hostname, (upReader, upWriter))
+            upWriter = None
+        return response, framed
+    finally:
+        steps.close()
+        if upWriter:
+            upWriter.close()
+
+
+# asyncio version of handle_client, uses the same request parsing and cache layout
+async def handle_client_async(reader, writer):
+    addr = writer.get_extra_info("peername")
+    parser = RequestParser()
+    served = 0
+    metrics.connection(1)
+    try:
         print(f"[CONN] Received connection from: {addr}")
-        message = tcpCliSock.recv(8190) # ~8KB
+        while served < clientMaxRequests:
+            start = time.perf_counter()
+            try:
+                request = parser.next_request()
+            except ValueError as e:
+                print(f"[ERROR] Bad request from {addr}: {e}")
+                writer.write(BAD_REQUEST)
+                await writer.drain()
+                return
+            if request is None:
+                data = await asyncio.wait_for(reader.read(65536), clientIdleTimeout)
+                if not data: # client closed the connection
+                    return
+                parser.feed(data)
+                continue
+            served += 1
+            metrics.observe("parse", time.perf_counter() - start)
+            if request.method == "CONNECT":
+                await tunnel_async(reader, writer, request.target, bytes(parser.buffer))
+                return
+            if request.method not in ("GET", "HEAD"):
+                print(f"[ERROR] Can't forward {request.method} from {addr}")
+                writer.write(NOT_IMPLEMENTED)
+                await writer.drain()
+                return
+            start = time.perf_counter()
+            if request.method == "HEAD":
+                framed = await serve_head_async(writer, request.head, request.accepts_gzip())
+            else:
+                framed = await serve_request_async(writer, request.head, request.accepts_gzip(),
+                                                   request.byte_range())
+            metrics.observe("request", time.perf_counter() - start)
+            if not framed:
+                return # the response could only be ended by closing the connection
+            if not request.keep_alive():
+                return
+
+    except asyncio.TimeoutError:
+        print(f"[CONN] Closing idle connection from {addr}")
+
+    except Exception as e:
+        print(f"[ERROR] Exception while serving {addr}:\n{e}")
+
+    finally:
+        # Close client socket
+        writer.close()
+        try:
+            await writer.wait_closed()
+        except OSError:
+            pass
+        metrics.connection(-1)
+        if verbose:
+            print(f"[STATS] {cacheStats.summary()}")
+
+
+# asyncio version of open_tunnel, the event loop relays the tunnel itself in reads of up to
+# tunnelRelay.bufferBytes, each direction in its own task
+async def tunnel_async(reader, writer, target, leftover):
+    hostname = tunnel_target(target)
+    if hostname is None:
+        print(f"[ERROR] Refusing tunnel to {target}")
+        writer.write(FORBIDDEN)
+        await writer.drain()
+        return
+    status = negativeCache.host_down(hostname)
+    if status is not None:
+        writer.write(GATEWAY_ERRORS[status])
+        await writer.drain()
+        return
+    try:
+        upReader, upWriter = await connect_upstream_async(hostname)
+    except (OSError, asyncio.TimeoutError) as e:
+        print(f"[ERROR] Could not open a tunnel to {hostname}: {e}")
+        writer.write(GATEWAY_ERRORS[upstream_failed(hostname, "", e, True).status])
+        await writer.drain()
+        return
+    print(f"[CONNECT] tunnel to {hostname}")
+    cacheStats.count("tunnels opened")
+    metrics.tunnel(1)
+    active = [time.monotonic()]
+
+    async def pump(src, dst):
+        while True:
+            data = await src.read(tunnelRelay.bufferBytes)
+            if not data:
+                break
+            active[0] = time.monotonic()
+            metrics.tunneled(len(data))
+            dst.write(data)
+            await dst.drain()
+        if dst.can_write_eof():
+            dst.write_eof() # pass the half-close on
+
+    try:
+        writer.write(TUNNEL_ESTABLISHED)
+        if leftover:
+            upWriter.write(leftover)
+        pumps = {asyncio.create_task(pump(reader, upWriter)), asyncio.create_task(pump(upReader, writer))}
+        try:
+            while pumps:
+                done, pumps = await asyncio.wait(pumps, timeout=TunnelRelay.SWEEP_INTERVAL)
+                for task in done:
+                    task.result() # raises what ended the pump
+                if pumps and time.monotonic() - active[0] > tunnelRelay.idleTimeout:
+                    print("[CONN] Closing idle tunnel")
+                    break
+        finally:
+            for task in pumps:
+                task.cancel()
+    except (ConnectionResetError, BrokenPipeError):
+        pass
+    finally:
+        upWriter.close()
+        metrics.tunnel(-1)
+
+
+# asyncio version of serve_head
+async def serve_head_async(writer, message, acceptsGzip=False):
+    if is_metrics_request(message):
+        response = metrics_response()
+        writer.write(response[:response.index(b"\r\n\r\n") + 4])
+        await writer.drain()
+        return True
+    target = parse_request(message)
+    if target is None:
+        writer.write(NOT_FOUND)
+        await writer.drain()
+        return True
+    hostname, filename = target
+    head = cached_head(cache_key(hostname, filename), acceptsGzip)
+    if head is not None:
+        writer.write(head)
+        await writer.drain()
+        metrics.served("disk", len(head))
+        return True
+    status = negativeCache.host_down(hostname)
+    if status is not None:
+        writer.write(GATEWAY_ERRORS[status])
+        await writer.drain()
+        return True
+    upWriter = None
+    try:
+        upReader, upWriter, data = await open_upstream_async(hostname, filename, method="HEAD")
+        response = ResponseParser("HEAD")
+        while True:
+            used = response.feed(data)
+            if response.done:
+                break
+            data = await asyncio.wait_for(upReader.read(65536), upstreamTimeout)
+            if not data:
+                return False
+        writer.write(response.head)
+        await writer.drain()
+        metrics.served("origin", len(response.head))
+        if used == len(data) and keeps_alive(response.head):
+            upstreamPool.release(hostname, (upReader, upWriter))
+            upWriter = None
+        return True
+    except UpstreamError as e:
+        print(f"[ERROR] Upstream failure:\n{e}")
+        writer.write(GATEWAY_ERRORS[e.status])
+        await writer.drain()
+        return True
+    finally:
+        if upWriter:
+            upWriter.close()
+
+
+# asyncio version of serve_request, returns True when the response was delimited
+async def serve_request_async(writer, message, acceptsGzip=False, byteRange=None):
+    if verbose:
         print(f"[MESSAGE] Message received: \n{message}")
+    if is_metrics_request(message):
+        writer.write(metrics_response())
+        await writer.drain()
+        return True
+    target = parse_request(message)
+    if target is None:
+        writer.write(NOT_FOUND)
+        await writer.drain()
+        return True
+    hostname, filename = target
+    key = cache_key(hostname, filename)
 
-        # Extract hostname and filename from the message
-        fullURL = message.split()[1][1:].decode() # decode URL into utf-8
-        if fullURL == "favicon.ico":
+    for coalesce in (True, False):
+        start = time.perf_counter()
+        response = memory_lookup(key, acceptsGzip) if byteRange is None else None # ranges are cut from files
+        if response is not None:
+            metrics.observe("lookup", time.perf_counter() - start)
+            writer.write(response)
+            metrics.served("memory", len(response))
+            await writer.drain()
+            return True
+
+        entry = disk_lookup(key)
+        metrics.observe("lookup", time.perf_counter() - start)
+        if entry is not None and entry.expiresAt > time.time():
+            framed = await serve_cached_async(writer, key, entry, acceptsGzip, byteRange)
+            if framed is not None:
+                return framed
+            entry = None
+
+        if entry is not None and serve_stale(entry):
+            framed = await serve_cached_async(writer, key, entry, acceptsGzip, byteRange)
+            if framed is not None:
+                print("[CACHE] Served stale copy, refreshing in the background")
+                cacheStats.count("stale served")
+                refresher.submit_async(key, lambda: refresh_entry_async(hostname, filename, key, entry))
+                return framed
+            entry = None
+
+        failure = negative_lookup(hostname, key)
+        if failure is not None:
+            framed = await serve_cached_async(writer, key, entry, acceptsGzip, byteRange) if entry is not None else None
+            if framed is not None:
+                return framed
+            writer.write(failure[0])
+            metrics.served("negative", len(failure[0]))
+            await writer.drain()
+            return failure[1]
+
+        rangeHeaders = range_headers(byteRange) if entry is None else b""
+        flight, leader = singleFlight.join(key) if coalesce and not rangeHeaders else (None, True)
+        if not leader:
+            print("[CACHE] Following an in-flight fetch")
+            cacheStats.count("coalesced")
+            framed = await follow_flight_async(writer, flight)
+            if framed is not None:
+                return framed
             continue
-        print(f"[INFO] URL: {fullURL}")
-        hostname = fullURL.partition('/')[0].replace("www.", "", 1)
-        filename = fullURL.partition('/')[2]
-        print(f"[INFO] Host: {hostname} File: {filename}")
 
-        fileExist = False
-        filetouse = f"./{hostname}{filename}"
-
-        try: # Check to see if the file is in the cache
-            print(f"[CACHE] Opening file {filetouse}")
-            if not os.path.exists(filetouse):
-                raise IOError
-            f = open(filetouse, "r")
-            outputdata = f.readlines()
-            fileExist = True
-            print("[CACHE] Cache hit")
-
-            # Proxy finds a cache hit and generates a response
-            tcpCliSock.send("HTTP/1.1 200 OK\r\n".encode())
-            tcpCliSock.send("Content-Type:text/html\r\n".encode())
-            # Send the output data from the cache hit
-            for data in outputdata:
-                tcpCliSock.send(data.encode())
-            print("[CACHE] Read from cache")
-
-        except IOError: # handling if the file isn't cached
-            if fileExist == False:
+        lock = None
+        try:
+            # another worker process may be fetching it already, then serve what it cached
+            lock, waited = await processLocks.acquire_async(key, connectTimeout + upstreamTimeout)
+            fetched = diskCache.lookup(key) if waited else None
+            if fetched is not None and fetched.expiresAt > time.time():
+                framed = await serve_cached_async(writer, key, fetched, acceptsGzip, byteRange)
+                if framed is not None:
+                    cacheStats.count("fetched by another process")
+                    return framed
+
+            conditional = conditional_headers(entry) if entry is not None else b""
+            if conditional:
+                print("[CACHE] Cache entry is stale, revalidating")
+            else:
                 print("[CACHE] Cache miss")
-                # create an external connection socket on the proxy
-                c = socket(AF_INET, SOCK_STREAM)
-                # hostname already extracted
-                try:
-                    # connect to the host over port 80
-                    c.connect((hostname, 80))
-                    print(f"[CONNECT] connecting to {hostname}:80")
-                    # create temp file and ask port 80 to write to it
-                    fileobj = c.makefile('rwb', 0)
-                    fileobj.write(f"GET /{filename} HTTP/1.1\r\nHost: {hostname}\r\nConnection: keep-alive\r\n\r\n".encode())
-
-                    # Create a new file in the cache for the requested file
-                    # Also send the response in the buffer to client socket 
-                    # and the corresponding file in the cache
-                    tmpFile = open(filetouse, "wb")
-
-                    contentLen = -1
-                    while contentLen != 0:
-                        data = fileobj.readline()
-                        if data.split():
-                            if data.split()[0] == b'Content-Length:':
-                                contentLen = int(data.split()[1]) + 2 # needs the extra two for the \r\n after the header
-                                print(f"[INFO] Content Length: {contentLen}")
-                            else:
-                                if contentLen > 0:
-                                    contentLen = contentLen - len(data)
+            response, framed = await relay_upstream_async(writer, hostname, filename, key, conditional, flight,
+                                                          rangeHeaders)
+            if conditional and response.status == 304:
+                entry = await asyncio.get_running_loop().run_in_executor(None, revalidated, key, entry, response.head)
+                framed = await serve_cached_async(writer, key, entry, acceptsGzip, byteRange)
+                if framed is None: # lost the file in the meantime, fetch it again
+                    response, framed = await relay_upstream_async(writer, hostname, filename, key, flight=flight)
+            return framed
+        except UpstreamError as e:
+            print(f"[ERROR] Upstream failure:\n{e}")
+            framed = await serve_cached_async(writer, key, entry, acceptsGzip, byteRange) if entry is not None else None
+            if framed is not None:
+                return framed
+            writer.write(GATEWAY_ERRORS[e.status])
+            await writer.drain()
+            return True
+        except Exception as e:
+            print(f"[ERROR] Exception:\n{e}")
+            return False
+        finally:
+            processLocks.release(lock)
+            if flight is not None:
+                singleFlight.land(key, flight)
+    return False
 
-                        else:
-                            if contentLen > 0:
-                                contentLen = contentLen - len(data)
-
-                        tmpFile.write(data)
-                        tcpCliSock.send(data)
-                            
-
-                    # close files
-                    if tmpFile:
-                        tmpFile.close()
-                    if fileobj:
-                        fileobj.close()
-
-                except Exception as e:
-                    print(f"[ERROR] Exception:\n{e}")
-                    if tmpFile:
-                        tmpFile.close()
-                    if fileobj:
-                        fileobj.close()
-                
-                # close connection
-                if c:
-                    c.close()
-            
-            else: # something weird happened, no file found
-                print("[ERROR] 404: file not found")
 
-        # Close client socket
-        tcpCliSock.close()
+# asyncio version of refresh_entry
+async def refresh_entry_async(hostname, filename, key, entry):
+    flight, leader = singleFlight.join(key)
+    if not leader:
+        return
+    lock = processLocks.try_acquire(key) # None while another worker process refreshes it
+    try:
+        if lock is None:
+            return
+        conditional = conditional_headers(entry)
+        response, _ = await relay_upstream_async(None, hostname, filename, key, conditional, flight)
+        if conditional and response.status == 304:
+            await asyncio.get_running_loop().run_in_executor(None, revalidated, key, entry, response.head)
+        cacheStats.count("background refreshes")
+        print(f"[CACHE] Refreshed {key} in the background")
+    except Exception as e:
+        print(f"[ERROR] Background refresh of {key} failed:\n{e}")
+    finally:
+        processLocks.release(lock)
+        singleFlight.land(key, flight)
+
+
+# asyncio version of prefetch
+async def prefetch_async(hostname, filename):
+    key = cache_key(hostname, filename)
+    if diskCache.is_fresh(key) or negativeCache.response(key) or negativeCache.host_down(hostname):
+        return
+    flight, leader = singleFlight.join(key)
+    if not leader:
+        return
+    lock = processLocks.try_acquire(key) # None while another worker process fetches it
+    try:
+        if lock is None:
+            return
+        await relay_upstream_async(None, hostname, filename, key, flight=flight)
+        cacheStats.count("prefetched")
+    except Exception as e:
+        print(f"[ERROR] Prefetch of {key} failed:\n{e}")
+    finally:
+        processLocks.release(lock)
+        singleFlight.land(key, flight)
+
+
+# asyncio version of follow_flight
+async def follow_flight_async(writer, flight):
+    index = 0
+    done = False
+    while not done:
+        blocks, done = await flight.read_async(index)
+        if blocks is None:
+            if index:
+                print("[CACHE] Fell too far behind an in-flight fetch, closing the connection")
+                return False
+            break
+        for data in blocks:
+            writer.write(data)
+            metrics.served("coalesced", len(data))
+        index += len(blocks)
+        await writer.drain()
+    if not index:
+        await flight.settle_async()
+    return flight.framed if index else None
+
+
+# asyncio version of serve_cached
+async def serve_cached_async(writer, key, entry, acceptsGzip=False, byteRange=None):
+    print(f"[CACHE] Opening file {entry.path}")
+    try:
+        f = open(entry.path, "rb")
+    except IOError: # removed behind the index's back
+        await asyncio.get_running_loop().run_in_executor(None, diskCache.discard, key, entry.path)
+        return None
+    print("[CACHE] Cache hit")
+    loop = asyncio.get_running_loop()
+    with f:
+        ranges = requested_ranges(byteRange, entry)
+        if ranges is not None:
+            head, parts, trailer = partial_response(entry, ranges)
+            writer.write(head)
+            for prefix, start, count in parts:
+                writer.write(prefix)
+                await writer.drain()
+                await loop.sendfile(writer.transport, f, start, count)
+            writer.write(trailer)
+            await writer.drain()
+            served_ranges(head, parts, trailer)
+            return True
+        decompress = entry.identityHead is not None and not acceptsGzip
+        head = with_age(entry.identityHead if decompress else entry.responseHead, entry.ageBase)
+        if len(entry.responseHead) + entry.size <= memoryCache.maxEntryBytes:
+            # read in the default executor to keep disk reads off the event loop
+            body = await loop.run_in_executor(None, f.read)
+            memoryCache.put(key, entry.responseHead, body, entry.expiresAt, entry.ageBase, entry.identityHead)
+            if decompress:
+                body = await loop.run_in_executor(None, zlib.decompress, body, 31)
+            writer.write(head + body)
+            await writer.drain()
+        elif decompress:
+            writer.write(head)
+            decompressor = zlib.decompressobj(31)
+            while True:
+                data = await loop.run_in_executor(None, read_decompressed, f, decompressor)
+                if not data:
+                    break
+                writer.write(data)
+                await writer.drain()
+        else:
+            # uses os.sendfile on the client socket, falls back to reads and writes
+            writer.write(head)
+            await writer.drain()
+            await loop.sendfile(writer.transport, f, 0, entry.size)
+    metrics.served("disk", len(head) + (entry.identitySize if decompress else entry.size))
+    print("[CACHE] Read from cache")
+    return True
+
+
+# raise the open file limit as far as allowed, each idle client holds a descriptor and each tunnel
+# about six (two sockets, the client's dup and, with splice, four pipe ends)
+def raise_file_limit():
+    try:
+        import resource
+    except ImportError: # not available on Windows
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft != hard:
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+        except (ValueError, OSError):
+            pass
+
+
+# serve every client from a single event loop on the already listening socket
+# SIGTERM stops the loop the way asyncio.run stops it on Ctrl-C, by cancelling this task
+async def serve_asyncio(tcpSerSock):
+    server = await asyncio.start_server(handle_client_async, sock=tcpSerSock)
+    if prefetcher is not None:
+        prefetcher.start_async()
+    terminated = False
+
+    def terminate():
+        nonlocal terminated
+        terminated = True
+        task.cancel()
+    task = asyncio.current_task()
+    asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, terminate)
+    print("[STARTUP] Ready to accept requests")
+    try:
+        async with server:
+            await server.serve_forever()
+    except asyncio.CancelledError:
+        if terminated:
+            raise KeyboardInterrupt
+        raise
+
+
+# --processes: fork the worker processes from the master and keep that many running
+# returns only in a worker, which reopens the disk cache index (sqlite connections don't survive
+# a fork) and goes on to serve clients from the inherited listening socket
+def fork_workers(count, args):
+    global diskCache, processLocks
+    diskCache.close()
+    children = set()
+
+    stopping = False
+
+    # stop like on Ctrl-C, once: Ctrl-C reaches every process and the master then passes SIGTERM on,
+    # so later signals do nothing while shutting down
+    def stop(signum, frame):
+        nonlocal stopping
+        if not stopping:
+            stopping = True
+            raise KeyboardInterrupt
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    # True in the new worker, False in the master
+    def spawn():
+        sys.stdout.flush() # or the worker prints the master's buffered lines again
+        pid = os.fork()
+        if pid:
+            children.add(pid)
+        elif args.mode == "asyncio":
+            signal.signal(signal.SIGINT, signal.default_int_handler) # asyncio.run only handles Ctrl-C with this
+        return pid == 0
+
+    try:
+        for _ in range(count):
+            if spawn():
+                break
+        else:
+            print(f"[STARTUP] Started {count} worker processes")
+            while True:
+                pid, status = os.wait()
+                children.discard(pid)
+                print(f"[ERROR] Worker process {pid} exited with status {status}, starting another")
+                time.sleep(1)
+                if spawn():
+                    break
+    except KeyboardInterrupt:
+        print("[SHUTDOWN] Stopping worker processes")
+        for pid in children:
+            os.kill(pid, signal.SIGTERM) # each worker prints its counters on the way out
+        for pid in children:
+            os.waitpid(pid, 0)
+        sys.exit(0)
+    diskCache = DiskCache(args.cache_dir, args.cache_max_bytes, args.cache_policy, shared=True)
+    processLocks = ProcessLocks(os.path.join(args.cache_dir, "locks"))
+
+
+def main():
+    global memoryCache, diskCache, upstreamPool, dnsCache, negativeCache, refresher, clientIdleTimeout, clientMaxRequests
+    global defaultTtl, staleWhileRevalidate, connectTimeout, upstreamTimeout, compressCache, prefetcher
+    global metricsPath, verbose, writeBehind, sizeGate, tunnelRelay, tunnelPorts, signalWakeup, idleClients
+    args = parse_args(sys.argv[1:])
+    compressCache = args.compress
+    writeBehind = WriteBehind(args.write_behind_bytes)
+    sizeGate = SizeGate(args.large_object_bytes, args.max_object_bytes)
+    tunnelRelay = TunnelRelay(args.tunnel_buffer_bytes, args.tunnel_idle_timeout)
+    tunnelPorts = set(args.tunnel_ports)
+    metricsPath = args.metrics_path.encode()
+    verbose = args.verbose
+    defaultTtl = args.default_ttl
+    staleWhileRevalidate = args.stale_while_revalidate
+    refresher = Refresher(args.refresh_workers)
+    if args.prefetch:
+        prefetcher = Prefetcher(args.prefetch_workers, args.prefetch_queue)
+    dnsCache = DnsCache(args.dns_ttl, args.dns_negative_ttl)
+    negativeCache = NegativeCache(args.negative_ttl)
+    connectTimeout = args.connect_timeout
+    upstreamTimeout = args.upstream_timeout
+    clientIdleTimeout = args.client_idle_timeout
+    clientMaxRequests = args.client_max_requests
+    if args.mode == "threads":
+        idleClients = IdleClients(clientIdleTimeout)
+    memoryCache = MemoryCache(args.memory_cache_bytes)
+    diskCache = DiskCache(args.cache_dir, args.cache_max_bytes, args.cache_policy)
+    if args.mode == "asyncio":
+        upstreamPool = UpstreamPool(args.upstream_max_idle, args.upstream_max_per_host, args.upstream_idle_timeout,
+                                    stream_is_idle, lambda conn: conn[1].close())
+    else:
+        upstreamPool = UpstreamPool(args.upstream_max_idle, args.upstream_max_per_host, args.upstream_idle_timeout,
+                                    socket_is_idle, lambda conn: conn.close())
+    print(f"[STARTUP] Disk cache {args.cache_dir}: {diskCache.total_bytes()} of {args.cache_max_bytes} bytes used")
+
+    # define the server IP and port from argv
+    SERVER = args.server_ip # localhost resolves to 127.0.0.1
+    PORT = args.port # 5000 by default, arbitrary
+
+    # create a server socket, bing it to a port and start listening
+    tcpSerSock = socket(AF_INET, SOCK_STREAM) # Init socket
+    tcpSerSock.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1) # allow quick restarts
+    tcpSerSock.bind((SERVER, PORT)) # Bind socket to port
+    tcpSerSock.listen(args.backlog) # Listen for page requests
+
+    try:
+        raise_file_limit()
+        if args.processes > 1:
+            fork_workers(args.processes, args)
+        if args.mode != "asyncio": # the event loop wakes up for signals itself
+            signalWakeup = watch_signals(tcpSerSock)
+        if prefetcher is not None and args.mode != "asyncio":
+            prefetcher.start()
+        if args.mode == "threads":
+            serve_threaded(tcpSerSock, args.workers, args.backlog)
+        elif args.mode == "asyncio":
+            asyncio.run(serve_asyncio(tcpSerSock))
+        else:
+            serve_serial(tcpSerSock)
+    except KeyboardInterrupt:
+        print("[SHUTDOWN] Stopping proxy")
+        print(f"[STATS] {cacheStats.summary()}")
+        print(f"[STATS] upstream pool: {upstreamPool.summary()}")
+        print(f"[STATS] dns: {dnsCache.summary()}")
+        print(f"[STATS] timing: {metrics.summary()}")
+        print(f"[STATS] disk index: {diskCache.filtered} lookups answered by the key filter")
+    finally:
+        tcpSerSock.close()
 
 
 if __name__ == '__main__':
-    main()
+    main()
\ No newline at end of file
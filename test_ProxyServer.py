@@ -0,0 +1,238 @@
+'''
+Tests for the framing, range and freshness rules of ProxyServer.py
+Run with "python -m pytest test_ProxyServer.py" or "python -m unittest test_ProxyServer"
+'''
+
+import email.utils
+import unittest
+
+import ProxyServer
+from ProxyServer import MAX_RANGES, RequestParser, ResponseParser, freshness_lifetime, parse_range
+
+
+# feed data to a new ResponseParser in pieces of step bytes, returns (parser, decoded body, bytes used)
+def parse_response(data, step=None, method="GET"):
+    response = ResponseParser(method)
+    body = []
+    used = 0
+    step = step or len(data)
+    for i in range(0, len(data), step):
+        used += response.feed(data[i:i + step])
+        body += response.take_body()
+        if response.done:
+            break
+    return response, b"".join(body), used
+
+
+# an HTTP date for seconds since the epoch
+def http_date(seconds):
+    return email.utils.formatdate(seconds, usegmt=True)
+
+
+# chunked and trailer framing, Content-Length and close-delimited bodies
+class ResponseFramingTest(unittest.TestCase):
+    CHUNKED = (b"HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n"
+               b"5\r\nhello\r\n6;name=value\r\n world\r\n0\r\n\r\n")
+
+    def test_chunked(self):
+        response, body, used = parse_response(self.CHUNKED)
+        self.assertTrue(response.done)
+        self.assertEqual(response.mode, "chunked")
+        self.assertEqual(body, b"hello world")
+        self.assertEqual(used, len(self.CHUNKED))
+
+    def test_chunked_one_byte_at_a_time(self):
+        response, body, used = parse_response(self.CHUNKED, step=1)
+        self.assertTrue(response.done)
+        self.assertEqual(body, b"hello world")
+        self.assertEqual(used, len(self.CHUNKED))
+
+    def test_chunked_trailer(self):
+        data = (b"HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\nTrailer: Expires\r\n\r\n"
+                b"3\r\nabc\r\n0\r\nExpires: Thu, 01 Jan 2026 00:00:00 GMT\r\nX-Other: 1\r\n\r\n")
+        for step in (None, 1, 7):
+            response, body, used = parse_response(data, step)
+            self.assertTrue(response.done)
+            self.assertEqual(body, b"abc")
+            self.assertEqual(used, len(data))
+
+    def test_trailer_not_done_before_empty_line(self):
+        response, body, used = parse_response(b"HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n"
+                                              b"0\r\nX-Trailer: 1\r\n")
+        self.assertFalse(response.done)
+        self.assertRaises(IOError, response.eof)
+
+    def test_chunked_stops_at_the_next_response(self):
+        second = b"HTTP/1.1 204 No Content\r\n\r\n"
+        response, body, used = parse_response(self.CHUNKED + second)
+        self.assertTrue(response.done)
+        self.assertEqual(used, len(self.CHUNKED))
+
+    def test_bad_chunk_size(self):
+        response = ResponseParser()
+        self.assertRaises(ValueError, response.feed,
+                          b"HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\nzz\r\n")
+
+    def test_content_length(self):
+        data = b"HTTP/1.1 200 OK\r\nContent-Length: 5\r\n\r\nhelloHTTP/1.1"
+        response, body, used = parse_response(data)
+        self.assertTrue(response.done)
+        self.assertEqual(body, b"hello")
+        self.assertEqual(used, len(data) - len(b"HTTP/1.1"))
+
+    def test_close_delimited(self):
+        response, body, used = parse_response(b"HTTP/1.0 200 OK\r\n\r\nsome body")
+        self.assertEqual(response.mode, "close")
+        self.assertFalse(response.done)
+        response.eof()
+        self.assertTrue(response.done)
+        self.assertEqual(body, b"some body")
+
+    def test_no_body(self):
+        for data, method in ((b"HTTP/1.1 304 Not Modified\r\nContent-Length: 10\r\n\r\n", "GET"),
+                             (b"HTTP/1.1 204 No Content\r\n\r\n", "GET"),
+                             (b"HTTP/1.1 200 OK\r\nContent-Length: 10\r\n\r\n", "HEAD")):
+            response, body, used = parse_response(data, method=method)
+            self.assertTrue(response.done)
+            self.assertEqual(response.mode, "none")
+            self.assertEqual(used, len(data))
+
+
+# interim 1xx responses are skipped and counted in interimLen
+class InterimResponseTest(unittest.TestCase):
+    INTERIM = (b"HTTP/1.1 100 Continue\r\n\r\n"
+               b"HTTP/1.1 103 Early Hints\r\nLink: </style.css>; rel=preload\r\n\r\n")
+    FINAL = b"HTTP/1.1 200 OK\r\nContent-Length: 2\r\n\r\nok"
+
+    def test_skipped(self):
+        for step in (None, 1, 10):
+            response, body, used = parse_response(self.INTERIM + self.FINAL, step)
+            self.assertEqual(response.status, 200)
+            self.assertEqual(response.interimLen, len(self.INTERIM))
+            self.assertTrue(response.head.startswith(b"HTTP/1.1 200 OK"))
+            self.assertEqual(body, b"ok")
+            self.assertEqual(used, len(self.INTERIM + self.FINAL))
+
+    def test_only_interim_so_far(self):
+        response, body, used = parse_response(self.INTERIM)
+        self.assertIsNone(response.head)
+        self.assertIsNone(response.status)
+        self.assertFalse(response.done)
+
+
+# request framing for persistent and pipelined client connections
+class RequestParserTest(unittest.TestCase):
+    def test_pipelined(self):
+        parser = RequestParser()
+        parser.feed(b"GET /a HTTP/1.1\r\nHost: x\r\n\r\n\r\nPOST /b HTTP/1.1\r\nContent-Length: 3\r\n\r\nabcGET /c")
+        first = parser.next_request()
+        second = parser.next_request()
+        self.assertEqual((first.method, first.target, first.body), ("GET", "/a", b""))
+        self.assertEqual((second.method, second.target, second.body), ("POST", "/b", b"abc"))
+        self.assertIsNone(parser.next_request())
+        parser.feed(b" HTTP/1.0\r\n\r\n")
+        third = parser.next_request()
+        self.assertEqual((third.target, third.version), ("/c", "HTTP/1.0"))
+        self.assertFalse(third.keep_alive())
+
+    def test_unframeable(self):
+        for data in (b"GET /\r\n\r\n", b"POST / HTTP/1.1\r\nTransfer-Encoding: chunked\r\n\r\n",
+                     b"POST / HTTP/1.1\r\nContent-Length: -1\r\n\r\n"):
+            parser = RequestParser()
+            parser.feed(data)
+            self.assertRaises(ValueError, parser.next_request)
+
+    def test_header_too_large(self):
+        parser = RequestParser(maxHeadBytes=16)
+        parser.feed(b"GET / HTTP/1.1\r\nHost: example")
+        self.assertRaises(ValueError, parser.next_request)
+
+
+# Range header parsing against a body of size bytes
+class ParseRangeTest(unittest.TestCase):
+    def test_single(self):
+        self.assertEqual(parse_range("bytes=0-99", 1000), [(0, 99)])
+        self.assertEqual(parse_range("bytes=900-", 1000), [(900, 999)])
+        self.assertEqual(parse_range("bytes=900-5000", 1000), [(900, 999)])
+
+    def test_suffix(self):
+        self.assertEqual(parse_range("bytes=-100", 1000), [(900, 999)])
+        self.assertEqual(parse_range("bytes=-5000", 1000), [(0, 999)])
+        self.assertEqual(parse_range("bytes=-1", 0), [])
+
+    def test_zero_suffix_is_unsatisfiable(self):
+        self.assertEqual(parse_range("bytes=-0", 1000), [])
+        self.assertEqual(parse_range("bytes=-0,0-9", 1000), [(0, 9)])
+
+    def test_past_the_end_is_unsatisfiable(self):
+        self.assertEqual(parse_range("bytes=1000-", 1000), [])
+        self.assertEqual(parse_range("bytes=5-9,1000-1001", 1000), [(5, 9)])
+
+    def test_overlapping_kept_in_order(self):
+        self.assertEqual(parse_range("bytes=0-99, 50-149,-10", 1000), [(0, 99), (50, 149), (990, 999)])
+
+    def test_invalid(self):
+        for value in ("items=0-9", "bytes=9-0", "bytes=", "bytes=-", "bytes=a-9", "bytes=0-9x", "bytes=5"):
+            self.assertIsNone(parse_range(value, 1000), value)
+
+    def test_too_many_ranges(self):
+        allowed = "bytes=" + ",".join(f"{i}-{i}" for i in range(MAX_RANGES))
+        self.assertEqual(len(parse_range(allowed, 1000)), MAX_RANGES)
+        self.assertIsNone(parse_range(allowed + f",{MAX_RANGES}-{MAX_RANGES}", 1000))
+
+
+# how long responses stay fresh from Cache-Control, Expires/Date and Last-Modified
+class FreshnessLifetimeTest(unittest.TestCase):
+    NOW = 1_800_000_000
+
+    def setUp(self):
+        self.defaultTtl = ProxyServer.defaultTtl
+
+    def tearDown(self):
+        ProxyServer.defaultTtl = self.defaultTtl
+
+    def test_not_cacheable(self):
+        self.assertIsNone(freshness_lifetime(200, [("Cache-Control", "no-store")], self.NOW))
+        self.assertIsNone(freshness_lifetime(200, [("Cache-Control", "private, max-age=60")], self.NOW))
+        self.assertIsNone(freshness_lifetime(404, [("Cache-Control", "max-age=60")], self.NOW))
+
+    def test_max_age(self):
+        self.assertEqual(freshness_lifetime(200, [("Cache-Control", "public, max-age=60")], self.NOW), 60)
+        self.assertEqual(freshness_lifetime(200, [("Cache-Control", "max-age=60, s-maxage=10")], self.NOW), 10)
+        self.assertEqual(freshness_lifetime(200, [("Cache-Control", "max-age=soon")], self.NOW), 0)
+        self.assertEqual(freshness_lifetime(200, [("Cache-Control", "no-cache")], self.NOW), 0)
+
+    def test_max_age_wins_over_expires(self):
+        headers = [("Cache-Control", "max-age=60"), ("Expires", http_date(self.NOW + 3600))]
+        self.assertEqual(freshness_lifetime(200, headers, self.NOW), 60)
+
+    def test_expires_against_date(self):
+        # the origin's clock runs an hour behind, Expires counts from its Date and not from ours
+        date = self.NOW - 3600
+        headers = [("Date", http_date(date)), ("Expires", http_date(date + 120))]
+        self.assertEqual(freshness_lifetime(200, headers, self.NOW), 120)
+
+    def test_expires_without_date(self):
+        self.assertEqual(freshness_lifetime(200, [("Expires", http_date(self.NOW + 300))], self.NOW), 300)
+
+    def test_expires_in_the_past_or_invalid(self):
+        headers = [("Date", http_date(self.NOW)), ("Expires", http_date(self.NOW - 60))]
+        self.assertEqual(freshness_lifetime(200, headers, self.NOW), 0)
+        self.assertEqual(freshness_lifetime(200, [("Expires", "0")], self.NOW), 0)
+
+    def test_heuristic_from_last_modified(self):
+        headers = [("Date", http_date(self.NOW)), ("Last-Modified", http_date(self.NOW - 1000))]
+        self.assertEqual(freshness_lifetime(200, headers, self.NOW), 100)
+
+    def test_heuristic_at_most_a_day(self):
+        headers = [("Last-Modified", http_date(self.NOW - 365 * 86400))]
+        self.assertEqual(freshness_lifetime(200, headers, self.NOW), 86400)
+
+    def test_default_ttl(self):
+        ProxyServer.defaultTtl = 30
+        self.assertEqual(freshness_lifetime(200, [("Date", http_date(self.NOW))], self.NOW), 30)
+        self.assertEqual(freshness_lifetime(301, [], self.NOW), 30)
+
+
+if __name__ == '__main__':
+    unittest.main()